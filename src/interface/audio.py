@@ -1,19 +1,236 @@
-import queue
+import collections
 import sys
+import threading
+from enum import Enum
+from time import perf_counter, sleep
 
-import librosa
-import librosa.display
-import matplotlib.pyplot as plt
 import numpy as np
-import sounddevice as sd
+
+
+class StreamingChroma:
+    """
+    Fast stand-in for librosa's chroma_cqt on the AudioClient's blocks. Every block is analysed on its own, like
+    chroma_cqt does, so nothing is carried over from one block to the next.
+    Follows chroma_cqt as the violin emission parameters were estimated with it: 12 bins per octave from C1 over 7
+    octaves, frames every hop_length samples centred from the start to the end of the zero padded block, each frame
+    max normalized, then averaged over the block like AudioClient.extract_chroma. The constant-Q transform of all
+    frames of a block is linear in the samples, so it is built once as a dense operator and every block then costs a
+    single matrix product. Tuning is taken to be exact rather than estimated from every block.
+    """
+
+    def __init__(self, sample_rate=44100, block_size=2048, hop_length=512, fmin=32.70319566, n_octaves=7,
+                 bins_per_octave=12):
+        """
+        :param sample_rate: audio sample rate
+        :param block_size: samples per block, longer blocks are cut to their last block_size samples
+        :param hop_length: samples between frames, chroma_cqt's default
+        :param fmin: frequency of the lowest C
+        :param n_octaves: number of octaves above fmin
+        :param bins_per_octave: constant-Q bins per octave, a multiple of 12
+        """
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.bins_per_semitone = bins_per_octave // 12
+        self.n_bins = n_octaves * bins_per_octave
+        self.centres = np.arange(0, block_size + 1, hop_length)
+
+        # Bin centers, grouped so that the middle bin of every group of bins_per_semitone sits on the semitone
+        bins = np.arange(self.n_bins)
+        self.frequencies = fmin * 2.0 ** ((bins - self.bins_per_semitone // 2) / bins_per_octave)
+        self.operator = self._build_operator(bins_per_octave)
+
+        self.chroma_map = np.zeros((12, self.n_bins))
+        self.chroma_map[(bins // self.bins_per_semitone) % 12, bins] = 1
+
+    def _build_operator(self, bins_per_octave):
+        """
+        Constant-Q transform of every frame of a block as one real matrix. Kernels are Hann windowed, L1 normalized
+        and scaled by the square root of their length like librosa's cqt, and cut where they reach past the block.
+        :return: (2 * frames * n_bins) x block_size matrix, the real parts of all frames followed by the imaginary parts
+        """
+        q = 1 / (2 ** (1 / bins_per_octave) - 1)
+        operator = np.zeros((len(self.centres), self.n_bins, self.block_size), dtype=complex)
+        for k, frequency in enumerate(self.frequencies):
+            length = q * self.sample_rate / frequency
+            n = np.arange(int(np.floor(-length / 2)), int(np.floor(length / 2)))
+            window = 0.5 - 0.5 * np.cos(2 * np.pi * (n - n[0]) / len(n))
+            kernel = window * np.exp(2j * np.pi * frequency * n / self.sample_rate)
+            kernel *= np.sqrt(length) / np.sum(np.abs(kernel))
+
+            for frame, centre in enumerate(self.centres):
+                position = centre + n
+                inside = (position >= 0) & (position < self.block_size)
+                operator[frame, k, position[inside]] = np.conj(kernel[inside])
+
+        operator = operator.reshape(-1, self.block_size)
+        return np.concatenate([operator.real, operator.imag]).astype(np.float32)
+
+    def process(self, block):
+        """
+        Compute the chroma vector of a block of audio.
+        :param block: mono audio samples, zero padded at the end if shorter than block_size
+        :return: 12 dimensional chroma vector, like np.mean(librosa.feature.chroma_cqt(block), axis=1)
+        """
+        block = block[-self.block_size:]
+        parts = self.operator[:, :len(block)] @ block
+        cqt = np.hypot(*parts.reshape(2, len(self.centres), self.n_bins))
+        chroma = cqt @ self.chroma_map.T
+
+        norm = np.max(chroma, axis=1, keepdims=True)
+        chroma /= np.maximum(norm, np.finfo(float).tiny)
+        return np.mean(chroma, axis=0)
+
+
+class QueueClosed(Exception):
+    """
+    Raised when taking from an ObservationQueue that was closed and has no observations left.
+    """
+
+
+class QueuePolicy(Enum):
+    Block = "block"  # producer waits for room, nothing is lost
+    DropOldest = "drop_oldest"  # oldest observation is discarded to make room
+    CatchUp = "catch_up"  # like DropOldest, and the consumer takes the whole backlog at once with get_batch
+
+
+class ObservationQueue:
+    """
+    Queue of observations between the AudioClient and the Follower. Unbounded by default like the queue.Queue it
+    replaces, a maxsize with the DropOldest or CatchUp policy keeps the follower from drifting behind the performer when
+    the model can't keep up. Records depth and lag so it can be monitored.
+    """
+
+    def __init__(self, maxsize=None, policy=QueuePolicy.Block):
+        """
+        :param maxsize: maximum number of observations, unbounded if None
+        :param policy: QueuePolicy applied when the queue is full
+        """
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # Metrics
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_timestamp = None  # capture time of the last observation taken
+        self.lag = 0.0  # seconds between capture and consumption of the last observation taken
+        self.max_lag = 0.0
+
+    def put(self, obs, timestamp=None):
+        """
+        Add an observation, applying the queue policy if the queue is full.
+        :param obs: observation
+        :param timestamp: perf_counter() of when the observation was captured, defaults to now
+        :return: None
+        """
+        timestamp = perf_counter() if timestamp is None else timestamp
+        with self.condition:
+            if self.policy == QueuePolicy.Block:
+                self.condition.wait_for(lambda: not self._full() or self.closed)
+            if self.closed:
+                return  # nobody is going to take it
+            elif self._full():
+                self.items.popleft()
+                self.dropped += 1
+
+            self.items.append((timestamp, obs))
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Take the oldest observation, waiting for one if the queue is empty.
+        :param timeout: seconds to wait, forever if None
+        :return: observation
+        :raises QueueClosed: if the queue was closed and is empty
+        """
+        return self._take(1, timeout)[0]
+
+    def get_batch(self, timeout=None):
+        """
+        Take every observation in the queue, waiting for at least one.
+        :param timeout: seconds to wait, forever if None
+        :return: list of observations, oldest first
+        :raises QueueClosed: if the queue was closed and is empty
+        """
+        return self._take(None, timeout)
+
+    def _full(self):
+        return self.maxsize is not None and len(self.items) >= self.maxsize
+
+    def _take(self, count, timeout):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0 or self.closed, timeout):
+                raise TimeoutError("No observation available")
+            if not self.items:
+                raise QueueClosed("No observations left")
+
+            count = len(self.items) if count is None else count
+            taken = [self.items.popleft() for _ in range(count)]
+            self.last_timestamp = taken[-1][0]
+            self.lag = perf_counter() - self.last_timestamp
+            self.max_lag = max(self.max_lag, perf_counter() - taken[0][0])
+            self.condition.notify_all()
+        return [obs for _, obs in taken]
+
+    def close(self):
+        """
+        Mark the end of the stream, consumers get the remaining observations and then QueueClosed. Observations put
+        after closing are discarded.
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __iter__(self):
+        with self.condition:
+            return iter([obs for _, obs in self.items])
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return len(self.items) == 0
+
+    def get_metrics(self):
+        """
+        :return: dict of current depth, max depth, dropped observations and lag in seconds
+        """
+        return {
+            "depth": len(self.items),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+        }
+
+
+class FeatureExtractionThread(threading.Thread):
+    """
+    Turns the raw audio blocks captured by the AudioClient into chroma vectors, off the audio callback thread.
+    """
+
+    def __init__(self, audio_client):
+        super().__init__(daemon=True)
+        self.audio_client = audio_client
+
+    def run(self):
+        self.audio_client.extract_features()
 
 
 class AudioClient:
     """
     Class that handles input from microphone
+    The audio callback only copies blocks into a preallocated ring buffer, chroma extraction happens on a
+    FeatureExtractionThread so that a slow extraction never makes the input stream overflow.
     """
 
-    def __init__(self, sample_rate=44100, window=200, channels=None, downsample=10, interval=30, blocksize=2048):
+    def __init__(self, sample_rate=44100, window=200, channels=None, downsample=10, interval=30, blocksize=2048,
+                 ring_size=64, streaming_chroma=False, queue_size=None, queue_policy=QueuePolicy.Block,
+                 tracer=None):
         if channels is None:
             channels = [1]
         self.sample_rate = sample_rate
@@ -23,23 +240,98 @@ class AudioClient:
         self.interval = interval
         self.blocksize = blocksize
         self.mapping = [c - 1 for c in self.channels]  # Channel numbers start with 1
-        self.q = queue.Queue()
+        self.q = ObservationQueue(queue_size, queue_policy)
         self.lines = None
         self.plotdata = None
         self.continue_recording = True
         self.frames_per_min = 1350
 
+        # Ring buffer between the audio callback (writer) and the feature extraction thread (reader).
+        # write_index and read_index only ever increase, slot = index % ring_size.
+        self.ring_size = ring_size
+        self.ring = np.zeros((ring_size, blocksize), dtype=np.float32)
+        self.ring_frames = np.zeros(ring_size, dtype=int)
+        self.ring_times = np.zeros(ring_size)  # perf_counter() when each block arrived, to measure queue lag
+        self.write_index = 0
+        self.read_index = 0
+        self.blocks_ready = threading.Semaphore(0)
+
+        self.streaming_chroma = StreamingChroma(sample_rate, blocksize) if streaming_chroma else None
+
+        # Overflow counters
+        self.input_overflows = 0  # blocks PortAudio reported as overflowed
+        self.ring_overflows = 0  # blocks dropped because feature extraction fell a full ring behind
+
+        # LatencyTracer the extraction stage is recorded to, if any
+        self.tracer = tracer
+
     def audio_callback(self, indata, frames, time, status):
         """This is called (from a separate thread) for each audio block."""
-        if status:
-            print(status, frames, time, file=sys.stderr)
+        if status.input_overflow:
+            self.input_overflows += 1
+
+        if self.write_index - self.read_index >= self.ring_size:
+            self.ring_overflows += 1
+            return
+
+        slot = self.write_index % self.ring_size
+        self.ring[slot, :frames] = indata[:, 0]
+        self.ring_frames[slot] = frames
+        self.ring_times[slot] = perf_counter()
+        self.write_index += 1
+        self.blocks_ready.release()
 
-        data = indata.copy().squeeze()
-        cqt = librosa.feature.chroma_cqt(y=data, sr=self.sample_rate)
+    def extract_features(self):
+        """
+        Feature extraction loop, turns every block in the ring buffer into a chroma vector on q.
+        Runs until recording stops and the ring buffer is drained.
+        :return: None
+        """
+        while self.continue_recording or self.read_index < self.write_index:
+            if not self.blocks_ready.acquire(timeout=0.1):
+                continue
+
+            slot = self.read_index % self.ring_size
+            chroma = self.extract_chroma(self.ring[slot, :self.ring_frames[slot]])
+            captured = self.ring_times[slot]
+            self.read_index += 1  # only release the slot once it has been read
+            self.q.put(chroma, captured)
+            if self.tracer is not None:
+                self.tracer.record("extract", perf_counter() - captured)
+
+    def extract_chroma(self, data):
+        """
+        Chroma vector of an audio block
+        :param data: mono audio samples
+        :return: 12 dimensional chroma vector
+        """
+        if self.streaming_chroma is not None:
+            return self.streaming_chroma.process(data)
+
+        import librosa  # pulls in scipy and numba, only load it when the streaming extractor isn't used
+
+        # 12 bins per octave, the default of the librosa the emission parameters were estimated with
+        cqt = librosa.feature.chroma_cqt(y=data, sr=self.sample_rate, bins_per_octave=12)
         cqt = np.mean(cqt, axis=1).reshape((cqt.shape[0], 1))
-        self.q.put(cqt.squeeze())
+        return cqt.squeeze()
+
+    def get_overflow_counts(self):
+        """
+        :return: dict of the number of blocks lost at each stage, and how many blocks are waiting for extraction
+        """
+        return {
+            "input_overflows": self.input_overflows,
+            "ring_overflows": self.ring_overflows,
+            "backlog": self.write_index - self.read_index,
+        }
 
     def record(self, plot=False, time=0):
+        import sounddevice as sd
+
+        self.continue_recording = True
+        feature_thread = FeatureExtractionThread(self)
+        feature_thread.start()
+
         stream = sd.InputStream(channels=1, callback=self.audio_callback, blocksize=self.blocksize,
                                 samplerate=self.sample_rate)
         with stream:
@@ -50,7 +342,19 @@ class AudioClient:
             else:
                 sd.sleep(time * 2000)
 
+        self.continue_recording = False
+        feature_thread.join()
+
+        overflows = self.get_overflow_counts()
+        if overflows["input_overflows"] or overflows["ring_overflows"]:
+            print("Dropped audio blocks:", overflows, file=sys.stderr)
+        if self.q.dropped:
+            print("Dropped observations:", self.q.get_metrics(), file=sys.stderr)
+
         if plot:
+            import librosa.display
+            import matplotlib.pyplot as plt
+
             full_plot = np.concatenate(self.q, axis=1)
             librosa.display.specshow(full_plot, y_axis='chroma', x_axis='time')
             plt.colorbar()
@@ -68,3 +372,81 @@ class AudioClient:
         print("Mean:", sample_mean)
         print("Cov: ", sample_cov)
         return sample_mean, sample_cov
+
+
+class ReplayAudioClient(AudioClient):
+    """
+    Stand-in for the AudioClient that plays back a recording instead of listening to the microphone, so the Follower
+    can run without audio hardware. Recordings are either chroma saved as a 12 x T .npy matrix (see
+    res/data/*_Recording.npy) or audio files, which go through extract_chroma block by block like live input.
+    Observations are put on the same queue at the live frame rate times speed, or as fast as they are consumed when
+    speed is None. The queue is closed at the end of the recording.
+    """
+
+    def __init__(self, path, speed=1.0, hop=None, **kwargs):
+        """
+        :param path: .npy chroma matrix or audio file
+        :param speed: playback speed relative to real time, unthrottled if None
+        :param hop: seconds between observations at speed 1, blocksize / sample_rate if None
+        :param kwargs: AudioClient arguments, e.g. queue_size and queue_policy
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self.speed = speed
+        self.hop = self.blocksize / self.sample_rate if hop is None else hop
+
+        if path.endswith(".npy"):
+            self.chroma = np.load(path).T
+            self.audio = None
+        else:
+            import librosa
+
+            self.chroma = None
+            self.audio, _ = librosa.load(path, sr=self.sample_rate, mono=True)
+
+    def __len__(self):
+        """
+        :return: number of observations in the recording
+        """
+        if self.chroma is not None:
+            return len(self.chroma)
+        return int(np.ceil(len(self.audio) / self.blocksize))
+
+    def get_frame(self, index):
+        """
+        :param index: observation index
+        :return: 12 dimensional chroma vector
+        """
+        if self.chroma is not None:
+            return self.chroma[index]
+        return self.extract_chroma(self.audio[index * self.blocksize:(index + 1) * self.blocksize])
+
+    def record(self, plot=False, time=0):
+        """
+        Put every observation of the recording on the queue, then close it. Stops early on stop_recording.
+        Observations are timestamped when they are due, for audio files before their chroma is extracted.
+        :param plot: ignored
+        :param time: seconds of the recording to play, all of it if 0
+        :return: None
+        """
+        self.continue_recording = True
+        num_frames = len(self) if time == 0 else min(len(self), int(time / self.hop))
+        interval = 0 if self.speed is None else self.hop / self.speed
+
+        start = perf_counter()
+        for index in range(num_frames):
+            if not self.continue_recording:
+                break
+            due = start + index * interval
+            delay = due - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+            captured = due if interval else perf_counter()
+            chroma = self.get_frame(index)
+            self.q.put(chroma, captured)
+            if self.tracer is not None and self.audio is not None:
+                self.tracer.record("extract", perf_counter() - captured)
+
+        self.continue_recording = False
+        self.q.close()
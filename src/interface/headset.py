@@ -1,46 +1,187 @@
 import logging
 import json
 import asyncio
+import queue
+import struct
+import threading
+import time
+from collections import namedtuple
 from enum import Enum
 
+import numpy as np
 from websockets import connect
+from websockets.exceptions import ConnectionClosed
 
-from src.music.note import Pitch
 from src.music.score import Pieces
 
 
+class HeadsetClosed(Exception):
+    """
+    Raised by HeadsetClient.receive once the connection to the server is gone and every message has been read.
+    """
+
+
 class HeadsetClient:
     """
     Websocket client responsible for sending/receiving information from headset.
+    The connection lives on an event loop in its own thread, with one task sending and one receiving, so send only
+    puts the message on a queue and never waits on the network. send and receive are safe to call from any thread.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_pending=256, tracer=None, room=""):
+        """
+        :param host: server address
+        :param port: server port
+        :param room: server room to join, see Server
+        :param max_pending: messages kept in each direction before the oldest is dropped
+        :param tracer: LatencyTracer to record the "send" stage to, if any
+        """
         self.host = host
         self.port = port
-        self.URL = f'ws://{self.host}:{self.port}'
+        self.URL = f'ws://{self.host}:{self.port}/{room}'
         self.ws = None
-        self.loop = asyncio.get_event_loop()
-        self.loop.run_until_complete(self.__async__connect())
+        self.max_pending = max_pending
+        self.tracer = tracer
 
-    def send(self, cmd):
-        return self.loop.run_until_complete(self.__async__send(cmd))
+        # Messages received from the server, read by receive()
+        self.inbox = queue.Queue(maxsize=max_pending)
+        self.dropped_outgoing = 0
+        self.dropped_incoming = 0
 
-    def receive(self):
-        return self.loop.run_until_complete(self.__async__receive())
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="HeadsetClient", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.__async__connect(), self.loop).result()
+
+    def send(self, cmd, timestamp=None):
+        """
+        Queue a message for the server without waiting for it to be sent.
+        :param cmd: dict to send as json, or str/bytes to send as is
+        :param timestamp: time.perf_counter() the message latency is measured from, if tracing
+        :return: None
+        """
+        self.loop.call_soon_threadsafe(self.__enqueue, (timestamp, cmd))
+
+    def receive(self, timeout=None):
+        """
+        Wait for the next message from the server.
+        :param timeout: seconds to wait, forever if None
+        :return: message
+        :raises queue.Empty: if nothing arrived within timeout
+        :raises HeadsetClosed: if the connection was closed
+        """
+        message = self.inbox.get(timeout=timeout)
+        if isinstance(message, HeadsetClosed):
+            self.inbox.put(message)  # every later call raises too
+            raise message
+        return message
+
+    def close(self, timeout=1.0):
+        """
+        Send what is still queued, close the connection and stop the event loop thread.
+        :param timeout: seconds to wait for queued messages to be sent, whatever is left after that is dropped
+        :return: None
+        """
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.__async__close(timeout), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def __enqueue(self, item):
+        if self.outbox.full():
+            self.outbox.get_nowait()
+            self.outbox.task_done()
+            self.dropped_outgoing += 1
+        self.outbox.put_nowait(item)
 
     async def __async__connect(self):
         logging.info(f"Connecting to {self.URL}")
         self.ws = await connect(self.URL)
+        self.outbox = asyncio.Queue(maxsize=self.max_pending)
+        self.send_task = asyncio.ensure_future(self.__async__send_loop())
+        self.receive_task = asyncio.ensure_future(self.__async__receive_loop())
         logging.info("Connected")
 
-    async def __async__send(self, cmd):
-        await self.ws.send(json.dumps(cmd))
-        return await self.ws.recv()
+    async def __async__close(self, timeout):
+        if not self.send_task.done():
+            try:
+                await asyncio.wait_for(self.outbox.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Dropped {self.outbox.qsize()} messages that could not be sent in time")
+        self.send_task.cancel()
+        self.receive_task.cancel()
+        await self.ws.close()
 
-    async def __async__receive(self):
-        message = await self.ws.recv()
-        print("Received: ", message)
-        return message
+    async def __async__send_loop(self):
+        while True:
+            timestamp, cmd = await self.outbox.get()
+            try:
+                await self.ws.send(cmd if isinstance(cmd, (str, bytes)) else json.dumps(cmd))
+            finally:
+                self.outbox.task_done()
+            if self.tracer is not None and timestamp is not None:
+                self.tracer.record("send", time.perf_counter() - timestamp)
+
+    async def __async__receive_loop(self):
+        # The server relays our own messages back to us too, keep only the latest ones nobody has read.
+        closed = HeadsetClosed("Connection to the server closed")
+        try:
+            async for message in self.ws:
+                self.__deliver(message)
+        except ConnectionClosed as e:
+            closed = HeadsetClosed(f"Connection to the server lost: {e}")
+        finally:
+            # Wake up whoever is waiting in receive() instead of leaving them blocked forever
+            self.__deliver(closed)
+
+    def __deliver(self, message):
+        if self.inbox.full():
+            try:
+                self.inbox.get_nowait()
+                self.dropped_incoming += 1
+            except queue.Empty:
+                pass
+        self.inbox.put_nowait(message)
+
+
+class NullHeadsetClient:
+    """
+    Stand-in for the HeadsetClient that discards every message, for running the Follower without a server.
+    Counts what would have been sent so message rates and sizes can still be measured.
+    """
+
+    def __init__(self, tracer=None):
+        """
+        :param tracer: LatencyTracer to record the "send" stage to, if any
+        """
+        self.tracer = tracer
+        self.sent = 0
+        self.sent_bytes = 0
+        self.last_message = None
+
+    def send(self, cmd, timestamp=None):
+        """
+        :param cmd: dict, str or bytes, see HeadsetClient.send
+        :param timestamp: time.perf_counter() the message latency is measured from, if tracing
+        :return: None
+        """
+        message = cmd if isinstance(cmd, (str, bytes)) else json.dumps(cmd)
+        self.sent += 1
+        self.sent_bytes += len(message)
+        self.last_message = message
+        if self.tracer is not None and timestamp is not None:
+            self.tracer.record("send", time.perf_counter() - timestamp)
+
+    def receive(self, timeout=None):
+        """
+        Nothing is ever received.
+        :param timeout: ignored
+        :raises queue.Empty:
+        """
+        raise queue.Empty
+
+    def close(self):
+        pass
 
 
 class MessageBuilder:
@@ -49,27 +190,45 @@ class MessageBuilder:
     """
 
     @staticmethod
-    def build_accompaniment_message(notes):
+    def build_accompaniment_message(pitches):
         """
         Build accompaniment message using pre-specified format
-        :param notes:
+        :param pitches: midi number of every part at the current event, -1 for a rest. See Score.get_part_pitches
         :return:
         """
         payload = {
             "type": MessageType.Accompaniment.value,
-            "data": {"inst" + str(part): notes[part].pitch if notes[part].pitch != Pitch.REST else -1 for part in
-                     range(len(notes))}
+            "data": {"inst" + str(part): int(pitch) for part, pitch in enumerate(pitches)}
         }
         return payload
 
+    @staticmethod
+    def build_accompaniment_frame(event, pitches, timestamp=None):
+        """
+        Build accompaniment message as a compact binary frame, see ACCOMPANIMENT_FRAME.
+        :param event: score event the pitches belong to
+        :param pitches: midi number of every part at the event, -1 for a rest. See Score.get_part_pitches
+        :param timestamp: time.time() the event was detected at, now if None
+        :return: bytes
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        header = ACCOMPANIMENT_FRAME.pack(ACCOMPANIMENT_FRAME_ID, event, timestamp, len(pitches))
+        return header + np.asarray(pitches, dtype=np.int8).tobytes()
+
     @staticmethod
     def parse_message(message):
         """
-        Parse information from incoming message
+        Parse information from incoming message, either json or a binary accompaniment frame
         :param message:
         :return:
         """
+        if isinstance(message, (bytes, bytearray)):
+            return MessageBuilder._parse_frame(message)
+
         json_msg = json.loads(message)
+        if json_msg["type"] == MessageType.Accompaniment.value:
+            pitches = [json_msg["data"][f"inst{part}"] for part in range(len(json_msg["data"]))]
+            return AccompanimentUpdate(None, pitches, None)
         if json_msg["type"] == MessageType.ChoosePiece.value:
             name = json_msg["data"]["song_name"]
             tempo = int(json_msg["data"]["tempo"])
@@ -83,8 +242,30 @@ class MessageBuilder:
         if json_msg["type"] == MessageType.Start.value:
             return MessageType.Start
 
+    @staticmethod
+    def _parse_frame(message):
+        frame_id, event, timestamp, num_parts = ACCOMPANIMENT_FRAME.unpack_from(message)
+        if frame_id != ACCOMPANIMENT_FRAME_ID:
+            raise ValueError(f"Unknown frame id {frame_id}")
+        pitches = np.frombuffer(message, dtype=np.int8, count=num_parts, offset=ACCOMPANIMENT_FRAME.size)
+        return AccompanimentUpdate(event, pitches.tolist(), timestamp)
+
 
 class MessageType(Enum):
     ChoosePiece = "song_selection"
     Start = "start"
     Accompaniment = "accompaniment"
+
+
+class MessageFormat(Enum):
+    Json = "json"  # one json accompaniment message per frame
+    Binary = "binary"  # ACCOMPANIMENT_FRAME
+
+
+# Binary accompaniment frame, little endian: frame id (uint8), event index (uint32), time.time() the event was
+# detected at (float64), number of parts (uint8), followed by one signed byte per part, the midi number or -1 for a rest.
+ACCOMPANIMENT_FRAME = struct.Struct("<BIdB")
+ACCOMPANIMENT_FRAME_ID = 1
+
+# Parsed accompaniment message. event and timestamp are None for json messages.
+AccompanimentUpdate = namedtuple("AccompanimentUpdate", ["event", "pitches", "timestamp"])
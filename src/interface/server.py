@@ -1,37 +1,196 @@
 import asyncio
+import collections
+import json
 import logging
-import time
+from enum import Enum
 
-from websockets import WebSocketServerProtocol
+from websockets import serve
+from websockets.exceptions import ConnectionClosed
+
+from src.interface.headset import MessageType
 
 logging.basicConfig(level=logging.INFO)
 
 
+class SlowClientPolicy(Enum):
+    DropOldest = "drop_oldest"  # a full queue drops its oldest message
+    Coalesce = "coalesce"  # only the latest accompaniment message is kept, then like DropOldest
+
+
+class ClientConnection:
+    """
+    One connected websocket with its own bounded outbound queue and writer task, so a slow client only ever delays
+    itself.
+    """
+
+    def __init__(self, ws, room, max_queue=64, policy=SlowClientPolicy.Coalesce):
+        self.ws = ws
+        self.room = room
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue = collections.deque()  # (message, is_accompaniment)
+        self.pending_accompaniments = 0  # accompaniment messages in the queue
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.sent = 0
+        self.writer = asyncio.ensure_future(self.write())
+
+    def enqueue(self, message, is_accompaniment=False):
+        """
+        Queue a message for this client, never waits.
+        :param message: str or bytes
+        :param is_accompaniment: whether the message only matters until the next accompaniment message
+        :return: None
+        """
+        if is_accompaniment and self.policy == SlowClientPolicy.Coalesce and self.pending_accompaniments:
+            pending = len(self.queue)
+            self.queue = collections.deque(item for item in self.queue if not item[1])
+            self.dropped += pending - len(self.queue)
+            self.pending_accompaniments = 0
+
+        if len(self.queue) >= self.max_queue:
+            _, evicted_accompaniment = self.queue.popleft()
+            self.pending_accompaniments -= evicted_accompaniment
+            self.dropped += 1
+        self.queue.append((message, is_accompaniment))
+        self.pending_accompaniments += is_accompaniment
+        self.ready.set()
+
+    async def write(self):
+        while True:
+            await self.ready.wait()
+            while self.queue:
+                message, is_accompaniment = self.queue.popleft()
+                self.pending_accompaniments -= is_accompaniment
+                try:
+                    await self.ws.send(message)
+                except ConnectionClosed:
+                    return  # distribute notices the closed connection and unregisters the client
+                self.sent += 1
+            self.ready.clear()
+
+    def close(self):
+        self.writer.cancel()
+
+
 # Code adapted from https://medium.com/better-programming/how-to-create-a-websocket-in-python-b68d65dbd549
 class Server:
-    clients = set()
+    """
+    Websocket relay between a follower and its headsets. Clients join the room named by the path they connect to,
+    e.g. ws://host:port/quartet, and only receive the messages sent in their room.
+    """
+
+    def __init__(self, max_queue=64, policy=SlowClientPolicy.Coalesce, echo=True):
+        """
+        :param max_queue: messages kept per client before the policy starts dropping
+        :param policy: SlowClientPolicy for clients that can't keep up
+        :param echo: whether messages are also relayed back to their sender
+        """
+        self.max_queue = max_queue
+        self.policy = policy
+        self.echo = echo
+        self.rooms = collections.defaultdict(set)
 
-    async def register(self, ws):
-        self.clients.add(ws)
-        logging.info(f'{ws.remote_address} connects.')
+    async def register(self, ws, room):
+        client = ClientConnection(ws, room, self.max_queue, self.policy)
+        self.rooms[room].add(client)
+        logging.info(f'{ws.remote_address} connects to room {room}.')
+        return client
 
-    async def unregister(self, ws):
-        self.clients.remove(ws)
-        logging.info(f'{ws.remote_address} disconnects')
+    async def unregister(self, client):
+        client.close()
+        self.rooms[client.room].discard(client)
+        if not self.rooms[client.room]:
+            del self.rooms[client.room]
+        logging.info(f'{client.ws.remote_address} disconnects from room {client.room}, '
+                     f'{client.sent} sent, {client.dropped} dropped')
 
-    async def send_to_clients(self, message):
-        if self.clients:
-            await asyncio.wait([client.send(message) for client in self.clients])
+    def send_to_clients(self, message, room, sender=None):
+        """
+        Queue a message for every client in a room.
+        :param message: str or bytes
+        :param room: room name
+        :param sender: ClientConnection the message came from, skipped unless echo is set
+        :return: None
+        """
+        is_accompaniment = self._is_accompaniment(message)
+        for client in self.rooms.get(room, ()):
+            if client is not sender or self.echo:
+                client.enqueue(message, is_accompaniment)
 
-    async def ws_handler(self, ws, url):
-        await self.register(ws)
+    async def ws_handler(self, ws, url=None):
+        client = await self.register(ws, self._get_room(ws, url))
         try:
-            await self.distribute(ws)
+            await self.distribute(client)
         finally:
-            await self.unregister(ws)
+            await self.unregister(client)
+
+    async def distribute(self, client):
+        try:
+            async for message in client.ws:
+                self.send_to_clients(message, client.room, client)
+        except ConnectionClosed:
+            pass  # headsets on wifi drop without a close handshake, unregister them like any other client
+
+    def get_metrics(self):
+        """
+        :return: dict of room name to number of clients, messages sent and messages dropped
+        """
+        return {room: {"clients": len(clients), "sent": sum(client.sent for client in clients),
+                       "dropped": sum(client.dropped for client in clients)} for room, clients in self.rooms.items()}
+
+    @staticmethod
+    def _get_room(ws, url):
+        # Older websockets pass the path to the handler, newer ones keep it on the request.
+        if url is None:
+            request = getattr(ws, "request", None)
+            url = request.path if request is not None else getattr(ws, "path", "/")
+        return url.split("?")[0].strip("/") or "default"
+
+    @staticmethod
+    def _is_accompaniment(message):
+        # Binary frames are always accompaniment, see MessageBuilder.build_accompaniment_frame
+        if isinstance(message, bytes):
+            return True
+        # Only parse messages that could be accompaniment, the word may also appear in other messages' data
+        if MessageType.Accompaniment.value not in message:
+            return False
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            return False
+        return isinstance(payload, dict) and payload.get("type") == MessageType.Accompaniment.value
+
+
+def run_server(connection, queue_size, policy, echo):
+    """
+    Run the relay Server in this process until the parent sends anything on the connection.
+    Sends back the port it listens on, then its room metrics and peak memory when stopped. Used by the load test and
+    replay scripts, peak memory is None where the resource module is missing (Windows).
+    :param connection: multiprocessing Pipe end
+    :param queue_size: Server max_queue
+    :param policy: SlowClientPolicy value
+    :param echo: Server echo
+    :return: None
+    """
+    server = Server(queue_size, SlowClientPolicy(policy), echo=echo)
+
+    async def run():
+        async with serve(server.ws_handler, "127.0.0.1", 0) as ws_server:
+            connection.send(ws_server.sockets[0].getsockname()[1])
+
+            # Rooms disappear as clients leave, so keep the last metrics seen while they were connected.
+            metrics = {}
+            loop = asyncio.get_running_loop()
+            while not await loop.run_in_executor(None, connection.poll, 0.2):
+                metrics = server.get_metrics() or metrics
+            connection.recv()
+
+        try:
+            import resource
+            peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            peak_rss_kb = None
+        connection.send({"rooms": metrics, "peak_rss_kb": peak_rss_kb})
 
-    async def distribute(self, ws: WebSocketServerProtocol):
-        print("Distributing Messages")
-        async for message in ws:
-            print(message, ws.remote_address, time.time())
-            await self.send_to_clients(message)
+    asyncio.run(run())
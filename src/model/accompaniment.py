@@ -1,4 +1,5 @@
-import fluidsynth
+import threading
+from time import perf_counter
 
 from src.music.note import Pitch
 
@@ -6,6 +7,8 @@ from src.music.note import Pitch
 class AccompanimentService:
 
     def __init__(self, score):
+        import fluidsynth  # only needed when playing accompaniment locally
+
         self.score = score
         self.fs = fluidsynth.Synth()
         self.fs.start(driver='coreaudio')
@@ -35,3 +38,174 @@ class AccompanimentService:
             if note not in self.current_notes and note.pitch != Pitch.REST and note.is_note_start:
                 self.fs.noteon(0, note.pitch, 100)
                 self.current_notes.add(note)
+
+
+class AccompanimentScheduler:
+    """
+    Plays the accompaniment of the next event when the soloist is expected to get there, instead of once the model
+    has noticed, which is at least a frame late. After every frame the onset of the next event is predicted from when
+    the follower reached the current one and the tempo estimate, and a timer thread plays the next event at that
+    time. If the follower reaches the pending event first it is played straight away, and if the follower goes
+    anywhere else the pending event is cancelled and the event the follower is at is played instead.
+    """
+
+    def __init__(self, play, sub_beat, num_events, lead=0.0, spin=0.0, tracer=None, clock=perf_counter, timer=True):
+        """
+        :param play: called with the event to play, e.g. AccompanimentService.play_accompaniment
+        :param sub_beat: beats per event, see Score.sub_beat
+        :param num_events: number of events in the score, nothing is scheduled past the last one
+        :param lead: seconds to play ahead of the predicted onset. The follower notices an event some time after it
+        started, at least half a frame on average, and the prediction starts from when it noticed.
+        :param spin: the timer sleeps until this many seconds before an event is due and busy waits the rest. Sleeps
+        alone are only as accurate as the OS scheduler tick, about a millisecond on Linux and up to 15 on Windows, but
+        busy waiting keeps a core busy and holds the GIL against the follower for up to spin seconds per event, so it
+        is off by default.
+        :param tracer: LatencyTracer to record the "accompaniment" and "early" stages to, if any
+        :param clock: returns the current time in seconds, on the same clock as the timestamps passed to update
+        :param timer: start the timer thread. Without it nothing is played ahead of the follower until poll is called,
+        e.g. to drive the scheduler from a simulated clock.
+        """
+        self.play = play
+        self.sub_beat = sub_beat
+        self.num_events = num_events
+        self.lead = lead
+        self.spin = spin
+        self.tracer = tracer
+        self.clock = clock
+
+        self.current_event = None
+        self.event_start = None  # capture time of the observation the follower reached current_event in
+        self.played_event = None
+        self.played_at = None
+        self.pending = None  # (due, event) of the event the timer will play next
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # Metrics
+        self.early = 0  # events played by the timer before the follower got there
+        self.late = 0  # pending events the follower got to first
+        self.cancelled = 0  # pending events dropped because the follower went somewhere else
+        self.mispredicted = 0  # events played by the timer that the follower did not move to next
+
+        self.thread = None
+        if timer:
+            self.thread = threading.Thread(target=self.run, name="AccompanimentScheduler", daemon=True)
+            self.thread.start()
+
+    def update(self, event, timestamp, tempo):
+        """
+        Tell the scheduler which event the follower is at, and reschedule the next one.
+        :param event: event the follower is at
+        :param timestamp: clock() of when the observation the event was found in was captured
+        :param tempo: tempo estimate in bpm, e.g. KalmanFilter.current_estimate
+        :return: None
+        """
+        with self.condition:
+            if event != self.current_event:
+                if event == self.played_event:
+                    # The timer already played it, the prediction was right
+                    self._record(timestamp)
+                else:
+                    if self.pending is not None and self.pending[1] == event:
+                        self.late += 1
+                        self.pending = None
+                    else:
+                        self._cancel()
+                    if self.played_event is not None and self.played_event != self.current_event:
+                        self.mispredicted += 1
+                    self._play(event)
+                    self._record(timestamp)
+                self.current_event = event
+                self.event_start = timestamp
+
+            next_event = event + 1
+            if next_event < self.num_events and next_event != self.played_event:
+                due = self.event_start + self.sub_beat * 60 / tempo - self.lead
+                if self.pending != (due, next_event):
+                    self.pending = (due, next_event)
+                    self.condition.notify_all()
+
+    def cancel(self):
+        """
+        Drop the pending event, e.g. when the follower lost its place.
+        :return: None
+        """
+        with self.condition:
+            self._cancel()
+
+    def close(self):
+        """
+        Drop the pending event and stop the timer thread.
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            self.pending = None
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def poll(self):
+        """
+        Play the pending event if it is due, what the timer thread does once it wakes up.
+        :return: None
+        """
+        with self.condition:
+            if self.pending is not None and self.pending[0] <= self.clock():
+                self._fire(self.pending)
+
+    def run(self):
+        with self.condition:
+            while not self.closed:
+                if self.pending is None:
+                    self.condition.wait()
+                    continue
+
+                pending = self.pending
+                remaining = pending[0] - self.clock()
+                if remaining > self.spin:
+                    self.condition.wait(remaining - self.spin)
+                    continue  # the pending event may have moved in the meantime
+
+                if remaining > 0:
+                    # Busy wait without the lock so update is never held up
+                    self.condition.release()
+                    try:
+                        while self.clock() < pending[0]:
+                            pass
+                    finally:
+                        self.condition.acquire()
+
+                self._fire(pending)
+
+    def get_metrics(self):
+        """
+        :return: dict of how many events were played early, late, cancelled and mispredicted
+        """
+        return {"early": self.early, "late": self.late, "cancelled": self.cancelled, "mispredicted": self.mispredicted}
+
+    def _fire(self, pending):
+        if self.pending == pending:
+            self.pending = None
+            self.early += 1
+            self._play(pending[1])
+
+    def _play(self, event):
+        self.play(event)
+        self.played_event = event
+        self.played_at = self.clock()
+
+    def _cancel(self):
+        if self.pending is not None:
+            self.pending = None
+            self.cancelled += 1
+            self.condition.notify_all()
+
+    def _record(self, timestamp):
+        # How long after the observation was captured the event played, or how long before if the timer played it
+        if self.tracer is None:
+            return
+        if self.played_at >= timestamp:
+            self.tracer.record("accompaniment", self.played_at - timestamp)
+        else:
+            self.tracer.record("early", timestamp - self.played_at)
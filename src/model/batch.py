@@ -0,0 +1,196 @@
+import logging
+
+import numpy as np
+
+from src.model.model import Model
+from src.utils.calculations import MathHelper
+
+
+class BatchModel:
+    """
+    Runs the forward algorithm of several Models (one per performer) as a single batch, so that many sessions can
+    be followed with one vectorized step per audio frame. Sessions can follow different pieces and instruments, their
+    events are padded to the longest piece and every session's break state is moved to the last row.
+    """
+
+    def __init__(self, models, scaled=True):
+        self.models = models
+        self.B = len(models)
+        self.N = max(model.N for model in models)
+        self.L = models[0].L
+        assert all(model.L == self.L for model in models), "All sessions need the same number of bottom states"
+
+        self.NUM_PITCHES = models[0].NUM_PITCHES
+        self.session_N = np.array([model.N for model in models])
+
+        # Emission parameters
+        self.mu_mat = np.zeros((self.B, self.NUM_PITCHES, 12))
+        self.det_mat = np.zeros((self.B, self.NUM_PITCHES))
+        self.inv_mat = np.zeros((self.B, self.NUM_PITCHES, 12, 12))
+        self.inv_var = np.zeros((self.B, self.NUM_PITCHES, 12))
+        self.log_norm = np.zeros((self.B, self.NUM_PITCHES))
+        self.is_diagonal = all(model.emissions.is_diagonal for model in models)
+        self.pitch_weights = np.zeros((self.B, self.N + 1, self.NUM_PITCHES, self.L))
+
+        # Transition parameters, see Model
+        self.pi = np.zeros((self.B, self.N + 1, self.L))
+        self.a_full = np.zeros((self.B, self.N + 1, 3, self.L, self.L))
+        self.pause_state_a = np.zeros((self.B, self.L, self.L))
+        self.a_from_break = np.zeros((self.B, self.N + 1, self.L, self.L))
+        self.jump_out = np.zeros((self.B, self.N + 1))
+        self.jump_in = np.zeros((self.B, self.N + 1))
+
+        # Forward algorithm variables
+        self.t = np.zeros(self.B, dtype=int)
+        self.alpha = np.zeros((self.B, self.N + 1, self.L))
+        self.scaled = scaled
+        self.log_likelihood = np.zeros(self.B)
+        self.total_log_likelihood = np.zeros(self.B)
+
+        # alpha padded with two empty events in front, alpha_full is a strided view on it, see Model.
+        self.alpha_padded = np.zeros((self.B, self.N + 3, self.L))
+        session_stride, row_stride, col_stride = self.alpha_padded.strides
+        self.alpha_full = np.lib.stride_tricks.as_strided(self.alpha_padded, shape=(self.B, self.N + 1, 3, self.L),
+                                                          strides=(session_stride, row_stride, row_stride,
+                                                                   col_stride),
+                                                          writeable=False)
+
+        for b in range(self.B):
+            self.initialize_emissions(b)
+            self.initialize_transitions(b)
+
+        logging.info(f"Batch Model Initialized with {self.B} sessions")
+
+    def initialize_emissions(self, b):
+        """
+        Copy the emission parameters of session b into the batch.
+        :param b: session index
+        :return: None
+        """
+        model = self.models[b]
+        self.mu_mat[b] = model.mu_mat
+        self.det_mat[b] = model.det_mat
+        self.inv_mat[b] = model.inv_mat
+        self.inv_var[b] = model.emissions.inv_var
+        self.log_norm[b] = model.emissions.log_norm
+        self.pitch_weights[b] = 0
+        self.pitch_weights[b, :model.N] = model.pitch_weights[:model.N]
+        self.pitch_weights[b, self.N] = model.pitch_weights[model.N]
+
+    def initialize_transitions(self, b):
+        """
+        Copy the transition parameters of session b into the batch. Has to be called again whenever the tempo of
+        the session changes.
+        :param b: session index
+        :return: None
+        """
+        model = self.models[b]
+        a_full, pause_state_a = model._get_a()
+
+        for batch_a in (self.pi, self.a_full, self.a_from_break, self.jump_out, self.jump_in):
+            batch_a[b] = 0
+        self.pi[b, :model.N] = model.pi[:model.N]
+        self.pi[b, self.N] = model.pi[model.N]
+        self.a_full[b, :model.N] = a_full[:model.N]
+        self.pause_state_a[b] = pause_state_a[0]
+        self.a_from_break[b, :model.N] = model.a_from_break[:model.N]
+        self.jump_out[b, :model.N] = model.jump_out[:model.N]
+        self.jump_in[b, :model.N] = model.jump_in[:model.N]
+
+    def update_tempo(self, b, tempo):
+        """
+        Change the tempo of session b.
+        :param b: session index
+        :param tempo: new tempo in bpm
+        :return: None
+        """
+        self.models[b].score.tempo = tempo
+        self.models[b].update_tempo()
+        self.initialize_transitions(b)
+
+    def reset(self, b):
+        """
+        Start following session b again from the beginning of its piece.
+        :param b: session index
+        :return: None
+        """
+        self.t[b] = 0
+        self.alpha[b] = 0
+        self.log_likelihood[b] = 0
+        self.total_log_likelihood[b] = 0
+
+    def b(self, observations):
+        """
+        Probability of observing each session's audio feature at each of its events.
+        :param observations: B x 12 matrix of chroma vectors
+        :return: B x N+1 x L matrix
+        """
+        if self.is_diagonal:
+            pdf = MathHelper.diagonal_norm_pdf(observations, self.mu_mat, self.inv_var, self.log_norm)
+        else:
+            y_t = np.stack([observations] * self.NUM_PITCHES, axis=1)
+            pdf = MathHelper.multivariate_norm_pdf(y_t, self.mu_mat, self.det_mat, self.inv_mat)
+        pdf = np.clip(pdf.reshape(self.B, self.NUM_PITCHES), 0, 0.999)
+
+        obs_prob = np.einsum('bk,bikl->bil', pdf, self.pitch_weights)
+        obs_prob[:, self.N] = np.einsum('bk,bkl->bl', np.clip(pdf, 0, 0.001), self.pitch_weights[:, self.N])
+        return obs_prob
+
+    def _get_jump_prob(self):
+        """
+        Batched Model._get_jump_prob.
+        :return: B x N+1 matrix
+        """
+        outflow = self.alpha[:, :, 0] * self.jump_out
+        total = np.sum(outflow, axis=1, keepdims=True)
+        cumulative = np.concatenate((np.zeros((self.B, 3)), np.cumsum(outflow, axis=1)), axis=1)
+        nbh_outflow = cumulative[:, 3:] - cumulative[:, :-3]
+        return self.jump_in * (total - nbh_outflow)
+
+    def next_observation(self, observations, active=None):
+        """
+        One forward algorithm step for every session.
+        :param observations: B x 12 matrix of chroma vectors, one per session
+        :param active: optional boolean vector of the sessions that received a frame, others are left untouched
+        :return: B vector of current events (break state is reported as the session's own N), B vector of their
+        probabilities
+        """
+        active = np.ones(self.B, dtype=bool) if active is None else np.asarray(active)
+        obs_prob = self.b(observations)
+
+        # calculate probability of making transition, jumping and going through the break state
+        self.alpha_padded[:, 2:] = self.alpha
+        trans_prob = np.einsum('bijk,bijkl->bil', self.alpha_full, self.a_full)
+        trans_prob[:, :, 0] += self._get_jump_prob()
+        trans_prob += np.einsum('bk,bikl->bil', self.alpha[:, self.N], self.a_from_break)
+        trans_prob[:, self.N] = np.einsum('bk,bkl->bl', self.alpha[:, self.N], self.pause_state_a)
+
+        # update alpha, sessions on their first frame start from the initial probabilities
+        trans_prob = np.where((self.t == 0)[:, None, None], self.pi, trans_prob)
+        self.alpha = np.where(active[:, None, None], obs_prob * trans_prob, self.alpha)
+        self.t += active
+        self._normalize_alpha(active)
+
+        flat_alpha = self.alpha.reshape(self.B, -1)
+        state = np.argmax(flat_alpha, axis=1)
+        events = state // self.L
+        events = np.where(events == self.N, self.session_N, events)
+        return events, flat_alpha[np.arange(self.B), state]
+
+    def _normalize_alpha(self, active):
+        """
+        Batched Model._normalize_alpha, only the active sessions are rescaled.
+        :param active: boolean vector of the sessions that received a frame
+        :return: None
+        """
+        if not self.scaled:
+            rescale = active & (np.max(self.alpha, axis=(1, 2)) < Model.UNSCALED_THRESHOLD)
+            self.alpha[rescale] *= Model.UNSCALED_RESCALE
+            return
+
+        scale = np.sum(self.alpha, axis=(1, 2))
+        rescale = active & (scale > 0)
+        self.alpha[rescale] /= scale[rescale, None, None]
+        with np.errstate(divide='ignore'):
+            self.log_likelihood[active] = np.log(scale[active])
+        self.total_log_likelihood[active] += self.log_likelihood[active]
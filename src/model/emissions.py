@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+
+import numpy as np
+from numpy.linalg import det, inv
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class EmissionPack:
+    """
+    Emission parameters of one instrument: a gaussian over chroma vectors for silence and each of the 12 pitch
+    classes, with the inverse and determinant of every covariance precomputed.
+    Row k of every array is pitch k - 1, so row 0 is silence.
+    Packs are shared between Models, so the arrays are read only.
+    """
+    VERSION = 1  # bump when the layout of the pack files changes
+    NUM_PITCHES = 13
+
+    def __init__(self, instrument, mu, sigma, inv_sigma=None, det_sigma=None):
+        """
+        :param instrument: name of the instrument
+        :param mu: 13 x 12 means
+        :param sigma: 13 x 12 x 12 covariances
+        :param inv_sigma: 13 x 12 x 12 inverse covariances, computed if None
+        :param det_sigma: 13 covariance determinants, computed if None
+        """
+        self.instrument = instrument
+        self.pitches = np.arange(-1, self.NUM_PITCHES - 1)
+        self.mu = mu
+        self.sigma = sigma
+        self.inv_sigma = inv(sigma) if inv_sigma is None else inv_sigma
+        self.det_sigma = det(sigma) if det_sigma is None else det_sigma
+        self.log_det_sigma = np.log(self.det_sigma)
+
+        # Diagonal covariances get a cheaper density, see MathHelper.diagonal_norm_pdf
+        off_diagonal = self.sigma * (1 - np.eye(self.sigma.shape[-1]))
+        self.is_diagonal = not np.any(off_diagonal)
+        self.inv_var = np.diagonal(self.inv_sigma, axis1=-2, axis2=-1).copy()
+        self.log_norm = 0.5 * (self.mu.shape[-1] * np.log(2 * np.pi) + self.log_det_sigma)
+
+        for array in (self.mu, self.sigma, self.inv_sigma, self.det_sigma, self.log_det_sigma, self.inv_var,
+                      self.log_norm):
+            array.flags.writeable = False
+
+    @staticmethod
+    def from_directory(instrument, res_dir):
+        """
+        Build a pack from the mean/mean_<pitch>.npy and cov/cov_<pitch>.npy files estimate_mean_cov.py writes.
+        Only the diagonal of each covariance is kept.
+        :param instrument: name of the instrument
+        :param res_dir: directory holding a directory per instrument
+        :return: EmissionPack
+        """
+        base_path = os.path.join(res_dir, instrument)
+        mu = np.zeros((EmissionPack.NUM_PITCHES, 12))
+        sigma = np.zeros((EmissionPack.NUM_PITCHES, 12, 12))
+        for index, pitch in enumerate(range(-1, EmissionPack.NUM_PITCHES - 1)):
+            mu[index] = np.load(f"{base_path}/mean/mean_{pitch}.npy").squeeze()
+            sigma[index] = np.diag(np.diag(np.load(f"{base_path}/cov/cov_{pitch}.npy").squeeze()))
+        return EmissionPack(instrument, mu, sigma)
+
+    def save(self, path):
+        """
+        :param path: npz file
+        :return: None
+        """
+        np.savez(path, version=np.array(self.VERSION), instrument=np.array(self.instrument), mu=self.mu,
+                 sigma=self.sigma, inv_sigma=self.inv_sigma, det_sigma=self.det_sigma)
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: npz file written by save
+        :return: EmissionPack
+        """
+        with np.load(path) as data:
+            if int(data["version"]) != EmissionPack.VERSION:
+                raise ValueError(f"{path} is version {int(data['version'])}, expected {EmissionPack.VERSION}")
+            return EmissionPack(str(data["instrument"]), data["mu"], data["sigma"], data["inv_sigma"],
+                                data["det_sigma"])
+
+    def get_mu(self, pitch):
+        """
+        :param pitch: pitch value, -1 for silence
+        :return: mean chroma vector of the pitch
+        """
+        return self.mu[pitch + 1]
+
+
+class EmissionRegistry:
+    """
+    Process wide cache of EmissionPacks, so every Model for an instrument shares one set of parameters and only the
+    first one reads them from disk. Packs are read from res/<instrument>.npz, falling back to building one from the
+    res/<instrument>/ directory.
+    """
+    RES_DIR = f"{THIS_DIR}/../../res"
+
+    packs = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, instrument, res_dir=RES_DIR):
+        """
+        :param instrument: name of the instrument
+        :param res_dir: directory holding the packs
+        :return: EmissionPack
+        """
+        key = (instrument, os.path.abspath(res_dir))
+        pack = cls.packs.get(key)
+        if pack is None:
+            with cls.lock:
+                pack = cls.packs.get(key)
+                if pack is None:
+                    pack = cls._load(instrument, res_dir)
+                    cls.packs[key] = pack
+        return pack
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.packs.clear()
+
+    @staticmethod
+    def _load(instrument, res_dir):
+        path = os.path.join(res_dir, f"{instrument}.npz")
+        if os.path.exists(path):
+            try:
+                return EmissionPack.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring emission pack {path}: {e}")
+
+        logging.info(f"No emission pack for {instrument}, loading {os.path.join(res_dir, instrument)}")
+        return EmissionPack.from_directory(instrument, res_dir)
@@ -1,15 +1,16 @@
 import logging
-import queue
+import sys
 import threading
 import time
 
-from src.interface.audio import AudioClient
-from src.interface.headset import HeadsetClient, MessageBuilder, MessageType
-from src.model.accompaniment import AccompanimentService
+from src.interface.audio import AudioClient, QueueClosed, QueuePolicy
+from src.interface.headset import HeadsetClient, MessageBuilder, MessageFormat, MessageType
+from src.model.accompaniment import AccompanimentScheduler, AccompanimentService
 from src.model.model import Model
 from src.model.tempo import KalmanFilter
 from src.music.score import Pieces
 from src.utils.calculations import MathHelper
+from src.utils.latency import LatencyTracer
 
 
 class RecordThread(threading.Thread):
@@ -23,33 +24,60 @@ class RecordThread(threading.Thread):
         self.audio_client.record()
 
 
-class HeadSetCommThread(threading.Thread):
-    def __init__(self, follower):
-        super().__init__()
-        self.follower = follower
-
-    def run(self):
-        while True:
-            message = self.follower.output_q.get()
-            self.follower.headset_client.send(message)
-
-
 class Follower:
     """
     Class that wraps together all the components needed to perform score following.
     """
 
     def __init__(self, with_headset: bool, piece: Pieces = None, bpm: int = 60, local_ip: str = None,
-                 port: int = None):
+                 port: int = None, trace_latency: bool = True, message_format: MessageFormat = MessageFormat.Json,
+                 send_on_change: bool = False, keepalive: float = None, room: str = "", audio_client=None,
+                 headset_client=None, verbose: bool = True, lookahead: bool = False, queue_size: int = None,
+                 queue_policy: QueuePolicy = QueuePolicy.Block, streaming_chroma: bool = False):
+        """
+        :param audio_client: source of observations, e.g. a ReplayAudioClient, a live AudioClient if None
+        :param headset_client: client accompaniment is sent to with a headset, e.g. a NullHeadsetClient, a
+        HeadsetClient connected to local_ip and port if None
+        :param verbose: print the state of every frame
+        :param lookahead: without a headset, play accompaniment at the predicted onset of each event with an
+        AccompanimentScheduler instead of once the model has found it
+        :param queue_size: observations the live AudioClient queues for the model, unbounded if None
+        :param queue_policy: QueuePolicy of the live AudioClient's queue, see ObservationQueue
+        :param streaming_chroma: extract the live AudioClient's chroma with StreamingChroma instead of librosa
+        """
         self.with_headset = with_headset
+        self.verbose = verbose
+
+        # With a headset the piece and the start signal come from the headset, unless the piece is given.
+        self.wait_for_start = with_headset and piece is None
+
+        # Headset protocol. With send_on_change accompaniment is only sent when the event changes, and again every
+        # keepalive seconds if given, instead of on every frame.
+        self.message_format = message_format
+        self.send_on_change = send_on_change
+        self.keepalive = keepalive
+        self.last_sent_event = None
+        self.last_sent_time = 0.0
+
+        # Per stage latency, measured from when the audio block was captured
+        self.tracer = LatencyTracer(enabled=trace_latency)
+        self.captured = None  # capture time of the observation the current state was computed from
+
+        # Clients passed in belong to the caller, the one connected here is closed once following ends
+        self.owns_headset_client = False
         try:
-            if self.with_headset:
+            if self.with_headset and headset_client is not None:
+                self.headset_client = headset_client
+                if self.headset_client.tracer is None:
+                    self.headset_client.tracer = self.tracer
+            elif self.with_headset:
                 assert local_ip is not None and port is not None
 
                 # Connect to Websocket Server
-                self.headset_client = HeadsetClient(local_ip, port)
-                self.output_q = queue.Queue()
+                self.headset_client = HeadsetClient(local_ip, port, tracer=self.tracer, room=room)
+                self.owns_headset_client = True
 
+            if self.wait_for_start:
                 logging.info(f"Waiting for Song Selection...")
                 song = MessageBuilder.parse_message(self.headset_client.receive())
                 while type(song) != Pieces:
@@ -57,7 +85,7 @@ class Follower:
                     time.sleep(0.05)
                     piece, bpm = MessageBuilder.parse_message(self.headset_client.receive())
                 logging.info(f"Song Selected: {song}, Tempo {bpm}")
-            else:
+            elif not self.with_headset:
                 assert piece is not None and bpm is not None
         except AssertionError as e:
             logging.error("Invalid Parameters")
@@ -66,24 +94,28 @@ class Follower:
             logging.error("An Error Occurred")
             raise Exception(e.args)
 
-        self.audio_client = AudioClient()
+        self.audio_client = audio_client if audio_client is not None else AudioClient(
+            queue_size=queue_size, queue_policy=queue_policy, streaming_chroma=streaming_chroma, tracer=self.tracer)
+        if self.audio_client.tracer is None:
+            self.audio_client.tracer = self.tracer
         self.model = Model(self.audio_client, piece=piece, tempo=bpm)
-        self.accompaniment = AccompanimentService(self.model.score)
+        self.accompaniment = AccompanimentService(self.model.score) if not self.with_headset else None
         self.tempo = KalmanFilter(self.model.score.tempo)
+
+        # Predictions start from the frame the follower noticed the current event in, which is after the event
+        # started, so scheduled events are played a frame ahead of them.
+        self.scheduler = None
+        if lookahead and self.accompaniment is not None:
+            frame_period = self.audio_client.blocksize / self.audio_client.sample_rate
+            self.scheduler = AccompanimentScheduler(self.accompaniment.play_accompaniment,
+                                                    self.model.score.sub_beat.value, self.model.score.N,
+                                                    lead=frame_period, tracer=self.tracer)
         self.math_helper = MathHelper()
 
         self.prev_state = None
         self.prev_note_val = None
         self.duration = 1
-
-    def _reset_probabilities(self, prob):
-        """
-        Resets probabilities in alpha table if they get too small to prevent underflow
-        :param prob: Probability returned by integration
-        :return: None
-        """
-        if prob < 1.0e-110:
-            self.model.alpha *= 1.0e100
+        self.dropped_frames = 0  # observations the queue dropped that have been counted towards the tempo
 
     def _play_accompaniment(self, current_state):
         """
@@ -93,7 +125,15 @@ class Follower:
         """
         if self.prev_state is not None and 2 >= current_state[0] - self.prev_state >= 0:
             note_event = current_state[0]
+            if self.scheduler is not None:
+                captured = self.captured if self.captured is not None else time.perf_counter()
+                self.scheduler.update(note_event, captured, self.tempo.current_estimate)
+                return
             self.accompaniment.play_accompaniment(note_event)
+            if self.captured is not None:
+                self.tracer.record("accompaniment", time.perf_counter() - self.captured)
+        elif self.scheduler is not None:
+            self.scheduler.cancel()  # the prediction was made before the follower jumped
 
     def _update_tempo(self, current_state):
         """
@@ -108,7 +148,8 @@ class Follower:
                 self.prev_note_val - 1].duration
             observed_fpb = self.duration * (1 / prev_expected_duration)  # This might be one off.
             observed_tempo = self.audio_client.frames_per_min / observed_fpb
-            print("Observed Tempo: ", observed_tempo)
+            if self.verbose:
+                print("Observed Tempo: ", observed_tempo)
 
             # perform kalman filter update.
             if abs(observed_tempo - self.model.score.tempo) < 20:
@@ -118,33 +159,87 @@ class Follower:
                     self.model.score.tempo = self.tempo.current_estimate
                     self.model.update_tempo()
 
-    def _get_observation(self, i):
+    def _get_observations(self, i):
         """
-        Get observation from queue
-        :param i:
-        :return:
+        Get observations from queue. Under the CatchUp policy every pending observation is taken at once so the
+        model can step through the backlog in a single call.
+        :param i: number of observations taken so far
+        :return: list of observations
         """
         if i == 0:
-            return self.model.mu["2"]  # Bullshit note to set alpha correctly.
+            self.captured = None
+            return [self.model.mu["2"]]  # Bullshit note to set alpha correctly.
+
+        if self.audio_client.q.policy == QueuePolicy.CatchUp:
+            observations = self.audio_client.q.get_batch()
         else:
-            return self.audio_client.q.get()
+            observations = [self.audio_client.q.get()]
+        self.captured = self.audio_client.q.last_timestamp
+        self.tracer.record("queue", time.perf_counter() - self.captured)
+
+        # Frames dropped from a full queue were still played, count them towards the current note's duration so the
+        # tempo estimate doesn't speed up.
+        dropped = self.audio_client.q.dropped
+        self.duration += dropped - self.dropped_frames
+        self.dropped_frames = dropped
+        return observations
+
+    def _track_duration(self, current_state):
+        """
+        Count frames spent on the current note and update the tempo when we move onto the next one.
+        :param current_state: state predicted by integration
+        :return: None
+        """
+        # get true event of current state, i.e. the half note when sub-beat is eighth.
+        played_note_val = self.model.score.get_true_note_event(current_state[0])
+        if self.prev_state is None:
+            self.prev_state = current_state[0]
+            self.prev_note_val = self.model.score.get_true_note_event(self.prev_state)
+            return
+        else:
+            self.prev_note_val = self.model.score.get_true_note_event(self.prev_state)
+
+        # Have we moved onto the next note
+        if played_note_val == self.prev_note_val:
+            self.duration += 1
+            self.prev_state = current_state[0]
+        else:
+            self._update_tempo(current_state)
+
+            self.duration = 0
+            self.prev_state = current_state[0]
+            self.prev_note_val = played_note_val
 
     def _send_accompaniment_to_headset(self, current_state):
-        message = MessageBuilder.build_accompaniment_message(self.model.score.parts[:, current_state[0]])
-        self.output_q.put(message)
-        pass
+        event = int(current_state[0])
+        now = time.time()
+        if self.send_on_change and event == self.last_sent_event and (
+                self.keepalive is None or now - self.last_sent_time < self.keepalive):
+            return
+        self.last_sent_event = event
+        self.last_sent_time = now
+
+        pitches = self.model.score.get_part_pitches(event)
+        if self.message_format == MessageFormat.Binary:
+            message = MessageBuilder.build_accompaniment_frame(event, pitches, now)
+        else:
+            message = MessageBuilder.build_accompaniment_message(pitches)
+        self.headset_client.send(message, self.captured)
+        if self.captured is not None:
+            self.tracer.record("accompaniment", time.perf_counter() - self.captured)
 
     def follow(self):
+        """
+        Follow the performance until the audio client's queue is closed, see ObservationQueue.close.
+        :return: number of observations followed
+        """
         ts = time.time()
         print("Start time: ", ts)
         try:
             record_thread = RecordThread(self.audio_client)
             record_thread.start()
 
-            if self.with_headset:
-                headset_thread = HeadSetCommThread(self)
-                headset_thread.start()
-
+            if self.wait_for_start:
                 logging.info("Waiting for Start Signal...")
                 while MessageBuilder.parse_message(self.headset_client.receive()) != MessageType.Start:
                     time.sleep(.05)
@@ -152,36 +247,52 @@ class Follower:
 
             i = 0
             while True:
-                # Get observation from audio client queue and perform forward algorithm step
-                obs = self._get_observation(i)
-                current_state, prob = self.model.next_observation(obs)
-                print(current_state, prob, self.duration, self.tempo.current_estimate)
-                i += 1
+                # Get observations from audio client queue and perform forward algorithm steps
+                try:
+                    observations = self._get_observations(i)
+                except QueueClosed:
+                    logging.info("Audio stream ended.")
+                    break
+                step_start = time.perf_counter()
+                if len(observations) == 1:
+                    states = [self.model.next_observation(observations[0])]
+                else:
+                    states = self.model.next_observations(observations)
+                self.tracer.record("model", time.perf_counter() - step_start)
+                i += len(observations)
+
+                # Frames we fell behind on only count towards the tempo, accompaniment follows the latest one.
+                for current_state, prob in states[:-1]:
+                    self._track_duration(current_state)
+
+                current_state, prob = states[-1]
+                if self.verbose:
+                    print(current_state, prob, self.duration, self.tempo.current_estimate)
 
-                self._reset_probabilities(prob)
                 if not self.with_headset:
                     self._play_accompaniment(current_state)
                 else:
                     self._send_accompaniment_to_headset(current_state)
 
-                # get true event of current state, i.e. the half note when sub-beat is eighth.
-                played_note_val = self.model.score.get_true_note_event(current_state[0])
-                if self.prev_state is None:
-                    self.prev_state = current_state[0]
-                    self.prev_note_val = self.model.score.get_true_note_event(self.prev_state)
-                    continue
-                else:
-                    self.prev_note_val = self.model.score.get_true_note_event(self.prev_state)
-
-                # Have we moved onto the next note
-                if played_note_val == self.prev_note_val:
-                    self.duration += 1
-                    self.prev_state = current_state[0]
-                else:
-                    self._update_tempo(current_state)
-
-                    self.duration = 0
-                    self.prev_state = current_state[0]
-                    self.prev_note_val = played_note_val
+                self._track_duration(current_state)
+            return i
         finally:
+            # Unblocks the audio client if it is waiting for room on the queue
+            self.audio_client.stop_recording()
+            self.audio_client.q.close()
+            if self.scheduler is not None:
+                self.scheduler.close()
+                logging.info(f"Scheduled accompaniment: {self.scheduler.get_metrics()}")
+            if self.owns_headset_client:
+                self.headset_client.close()  # sends the accompaniment still queued first
             print("Time Elapsed: ", time.time() - ts)
+            self.dump_latency()
+
+    def dump_latency(self, file=sys.stderr):
+        """
+        Print p50/p95/p99 latency of every pipeline stage, measured from audio capture except for "model" which is
+        the duration of the model step alone.
+        :param file: where to print
+        :return: None
+        """
+        self.tracer.dump(file)
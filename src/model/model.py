@@ -2,8 +2,8 @@ import logging
 import os
 
 import numpy as np
-from numpy.linalg import det, inv
 
+from src.model.emissions import EmissionRegistry
 from src.music.note import Pitch
 from src.music.score import Pieces, ScoreFactory
 from src.utils.calculations import MathHelper
@@ -12,13 +12,18 @@ THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 class Model:
+    # Without scaling, alpha is multiplied by UNSCALED_RESCALE whenever its largest entry drops below
+    # UNSCALED_THRESHOLD, so long recordings don't underflow to 0.
+    UNSCALED_THRESHOLD = 1.0e-110
+    UNSCALED_RESCALE = 1.0e100
 
-    def __init__(self, audio_client, tempo=None, instrument="violin", piece=Pieces.TestTwinkle):
+    def __init__(self, audio_client, tempo=None, instrument="violin", piece=Pieces.TestTwinkle, scaled=True,
+                 score=None, beam_width=None, beam_threshold=None, L=1):
         self.piece = piece
-        self.score = ScoreFactory.get_score(piece)
+        self.score = ScoreFactory.get_score(piece) if score is None else score
         if tempo is not None:
             self.score.tempo = tempo
-        self.L = 1
+        self.L = L  # bottom states per event, 2 adds a pause state after every note
         self.N = self.score.N
 
         self.NUM_PITCHES = 13
@@ -26,7 +31,13 @@ class Model:
         self.audio_client = audio_client
         self.math_helper = MathHelper()
 
-        self.a = np.zeros((self.N + 1, self.L, self.N + 1, self.L))  # transition matrix
+        # Banded transition matrix. Only the self loop, i+1 and i+2 transitions are stored per event,
+        # a_band[j, d, l', l] = a_{(j,l'),(j+d,l)} for d in {0, 1, 2} and j + d < N.
+        self.a_band = np.zeros((self.N + 1, 3, self.L, self.L))
+        self.a_to_break = np.zeros((self.N + 1, self.L, self.L))  # a_{(j,l'),(N,l)}, transitions into break state
+        self.a_from_break = np.zeros((self.N + 1, self.L, self.L))  # a_{(N,l'),(i,l)}, transitions out of break state
+        self.jump_out = np.zeros(self.N + 1)  # e_j * s, rank-1 factor of jumps out of event j. Eq. 12
+        self.jump_in = np.zeros(self.N + 1)  # r * pi_i, rank-1 factor of jumps into event i. Eq. 12
         self.pi = np.zeros((self.N + 1, self.L))  # initial probabilities matrix
         self.e = np.zeros((self.N + 1, self.L))  # exit probabilities matrix
 
@@ -52,6 +63,18 @@ class Model:
         self.t = 0
         self.alpha = np.zeros((self.N + 1, self.L))
 
+        # When scaled, alpha is normalized every frame and the scale factors are kept as log-likelihoods.
+        self.scaled = scaled
+        self.log_likelihood = 0.0  # log p(y_t | y_1:t-1) of the latest frame
+        self.total_log_likelihood = 0.0  # log p(y_1:t)
+
+        # Beam pruning. When enabled only events within beam_width of the most likely event and/or holding at
+        # least beam_threshold of the posterior mass are kept. beam_window is the [lo, hi) range of events
+        # alive after the last frame, None when the next frame has to look at the whole score.
+        self.beam_width = beam_width
+        self.beam_threshold = beam_threshold
+        self.beam_window = None
+
         self.initialize_initial_probabilities()
         self.initialize_transition_matrix()
         self.initialize_pitch_weights()
@@ -61,61 +84,33 @@ class Model:
 
     def initialize_overtones(self):
         """
-        Load emission probability parameters based on instrument
+        Load emission probability parameters based on instrument. Packs are cached by the EmissionRegistry, so only
+        the first Model for an instrument touches the disk.
         :return:
         """
-        base_path = self.MEAN_COV_DIR + self.instrument
-
-        # Load mean
-        directory = os.fsencode(base_path + "/mean/")
-        for file in os.listdir(directory):
-            filename = os.fsdecode(file)
-            note = filename.split('_')[1].split('.')[0]
-            self.mu[note] = np.load(base_path + "/mean/" + filename).squeeze()
-
-        # Load covariance
-        directory = os.fsencode(base_path + "/cov")
-        for file in os.listdir(directory):
-            filename = os.fsdecode(file)
-            note = filename.split('_')[1].split('.')[0]
-            temp = np.load(base_path + "/cov/" + filename).squeeze()
-            self.Sigma[note] = np.zeros(temp.shape)
-            np.fill_diagonal(self.Sigma[note], np.diag(temp))
-
-        # Load silence
-        self.mu["-1"] = np.load(base_path + "/mean/mean_-1.npy").squeeze()
-        temp = np.load(base_path + "/cov/cov_-1.npy").squeeze()
-        self.Sigma["-1"] = np.zeros(temp.shape)
-        np.fill_diagonal(self.Sigma["-1"], np.diag(temp))
+        self.emissions = EmissionRegistry.get(self.instrument, self.MEAN_COV_DIR)
+        for index, pitch in enumerate(self.emissions.pitches):
+            self.mu[str(pitch)] = self.emissions.mu[index]
+            self.Sigma[str(pitch)] = self.emissions.sigma[index]
 
         self.initialize_inv_det()
 
     def initialize_inv_det(self):
         """
-        Calculate Inverse and determinant for covariance matrices for each pitch.
-        inv_mat - N x 13 x 12 x 12
-        det_mat - N x 13
-        mu - N x 13 x 12
-        y_t - N x 13 x 12
+        Inverse and determinant for covariance matrices for each pitch, precomputed in the emission pack.
+        inv_mat - 13 x 12 x 12
+        det_mat - 13
+        mu_mat - 13 x 12
 
         13 is number of pitches, 12 is size of array that gets returned, cause 12 notes in octave.
+        Only one gaussian per pitch is kept, pitch_weights maps them onto the score events.
         :return:
         """
-        for pitch in self.Sigma:
-            self.inv_det[pitch] = (inv(self.Sigma[pitch]), det(self.Sigma[pitch]))
-
-        inv_mat = np.zeros((self.NUM_PITCHES, 12, 12))  # num pitches by (12,12) inv of covariance
-        det_mat = np.zeros(self.NUM_PITCHES)  # num pitches
-        mu_mat = np.zeros((self.NUM_PITCHES, 12))  # num_pitches by
-        for pitch in self.inv_det:
-            index = int(pitch) + 1
-            inv_mat[index, :, :] = self.inv_det[pitch][0]
-            det_mat[index] = self.inv_det[pitch][1]
-            mu_mat[index, :] = self.mu[pitch]
-
-        self.inv_mat = np.array([inv_mat] * (self.N + 1))
-        self.det_mat = np.array([det_mat] * (self.N + 1))
-        self.mu_mat = np.array([mu_mat] * (self.N + 1))
+        self.inv_mat = self.emissions.inv_sigma
+        self.det_mat = self.emissions.det_sigma
+        self.mu_mat = self.emissions.mu
+        for index, pitch in enumerate(self.emissions.pitches):
+            self.inv_det[str(pitch)] = (self.inv_mat[index], self.det_mat[index])
 
     def initialize_pitch_weights(self):
         """
@@ -124,11 +119,13 @@ class Model:
         i.e. if the expected note is a C, there's a small chance of hearing a different note.
         :return:
         """
-        pitches = [self.score.subdivided_notes[i].pitch.value for i in range(self.N)]
-        pitches.append(Pitch.REST.value)  # break state
-        pause_state_w = np.array(
-            [[self._get_weight(k, Pitch.REST.value) for k in range(self.NUM_PITCHES)]] * (self.N + 1))
-        zero_state_w = np.array([[self._get_weight(k, p_i) for k in range(self.NUM_PITCHES)] for p_i in pitches])
+        # w_{k,0} only depends on the expected pitch, so compute it once per pitch and look it up per event.
+        weight_table = np.array([[self._get_weight(k, p_i) for k in range(self.NUM_PITCHES)]
+                                 for p_i in range(Pitch.REST.value, self.NUM_PITCHES - 1)])
+
+        pitches = np.append(self.score.get_solo_pitches()[:self.N], Pitch.REST.value)
+        pause_state_w = np.stack([weight_table[Pitch.REST.value + 1]] * (self.N + 1))
+        zero_state_w = weight_table[pitches - Pitch.REST.value]
 
         if self.L == 1:
             self.pitch_weights = np.stack([zero_state_w], axis=2)
@@ -140,46 +137,49 @@ class Model:
         Initializes self loop probabilities a_{0,0}
         :return:
         """
+        self.a_full = None  # invalidate gathered band
 
-        np.fill_diagonal(self.a[:, 0, :, 0],
-                         self.math_helper.bpm_to_prob(self.score.tempo, beat_value=self.score.sub_beat.value,
-                                                      recording_speed=self.recording_speed))
-        self.a[self.N, 0, self.N, 0] = self.pause_self_loop
+        self.a_band[:, 0, 0, 0] = self.math_helper.bpm_to_prob(self.score.tempo, beat_value=self.score.sub_beat.value,
+                                                              recording_speed=self.recording_speed)
+        self.a_band[self.N, 0, 0, 0] = self.pause_self_loop
+        self.a_to_break[self.N, 0, 0] = self.pause_self_loop
 
     def initialize_transition_matrix(self):
         """
-        initializes transition matrix 'a'
-        where a[j,l',i,l] represents the transition probabilities of the standard HMM
-        from top state j bottom state l' to top state i bottom state l
+        initializes the banded transition matrix.
+        a_band[j,d,l',l] represents the transition probabilities of the standard HMM
+        from top state j bottom state l' to top state j+d bottom state l.
+        Transitions outside the band are either to/from the break state, kept in a_to_break/a_from_break,
+        or jumps, which are rank-1 (e_j * s * r * pi_i) and kept as the vectors jump_out/jump_in.
         :return:
         """
 
         self.parse_piece()
 
         if self.L == 2:
-            self.a[:, 1, :, 0] = 0  # a_{1,0}
-            self.a[:, 1, :, 1] = 0.999  # a_{1,1}
-            self.a[:, 0, :, 1] = 1.0e-100  # a_{0,1}
+            for a in (self.a_band, self.a_to_break, self.a_from_break):
+                a[..., 1, 0] = 0  # a_{1,0}
+                a[..., 1, 1] = 0.999  # a_{1,1}
+                a[..., 0, 1] = 1.0e-100  # a_{0,1}
 
-        for i in range(self.N):
+        self.initialize_exit_probabilities()
 
-            self.initialize_exit_probabilities(i)
+        skip = max(self.N - 2, 0)
+        self.a_band[:skip, 2, :, 0] = self.e[:skip, :] * self.p_del * self.pi[2:skip + 2, 0:1]  # a_{i, i+2}
 
-            if i < self.N - 2:
-                self.a[i, :, i + 2, 0] = self.e[i, :] * self.p_del * self.pi[i + 2, 0]  # a_{i, i+2}
-            if i < self.N - 1:
-                next_state_prob = 1 - self.s - self.a[i, 0, i, 0] - self.a[i, 0, i + 2, 0]
-                self.a[i, :, i + 1, 0] = self.e[i, :] * next_state_prob * self.pi[i + 1, 0]  # a_{i, i+1}
+        step = max(self.N - 1, 0)
+        next_state_prob = 1 - self.s - self.a_band[:step, 0, 0, 0] - self.a_band[:step, 2, 0, 0]
+        next_state_prob *= self.pi[1:step + 1, 0]
+        self.a_band[:step, 1, :, 0] = self.e[:step, :] * next_state_prob[:, None]  # a_{i, i+1}
 
-            for j in range(self.N):
-                if j - i > 2 or j - i < 0:  # j not in nbh(i)
-                    self.a[i, 0, j, 0] = self.e[i, 0] * self.s * self.r * self.pi[
-                        j, 0]  # Eq. 12 (j and i are backwards)
+        # transition probability to break state eq. 14
+        self.a_to_break[:self.N, 0, 0] = self.e[:self.N, 0] * self.s * self.pi[self.N, 0]
+        # transition probability away from break state eq.15
+        self.a_from_break[:self.N, 0, 0] = self.e[self.N, 0] * self.r * self.pi[:self.N, 0]
 
-            # transition probability to break state eq. 14
-            self.a[i, 0, self.N, 0] = self.e[i, 0] * self.s * self.pi[self.N, 0]
-            # transition probability away from break state eq.15
-            self.a[self.N, 0, i, 0] = self.e[self.N, 0] * self.r * self.pi[i, 0]
+        # j not in nbh(i), Eq. 12
+        self.jump_out[:self.N] = self.e[:self.N, 0] * self.s
+        self.jump_in[:self.N] = self.r * self.pi[:self.N, 0]
 
     def initialize_initial_probabilities(self):
         """
@@ -190,77 +190,111 @@ class Model:
         self.pi[:, 1:] = 0
         self.pi[self.N, 0] = 1
 
-    def initialize_exit_probabilities(self, i):
+    def initialize_exit_probabilities(self):
         """
         Initialize exit probabilities from bottom states
-        :param i:
         :return:
         """
-        self.e[i, :] = 1 - np.sum(self.a[i, :, i, :], axis=1)
-        self.e[self.N, 0] = 1 - self.a[self.N, 0, self.N, 0]
+        self.e[:self.N, :] = 1 - np.sum(self.a_band[:self.N, 0], axis=2)
+        self.e[self.N, 0] = 1 - self.a_to_break[self.N, 0, 0]
 
     def initialize_indexers(self):
         """
         Initializes matrices to help quickly index for alpha and a during forward algorithm steps.
+        Row i of the neighbourhood holds events i-2, i-1 and i, the only events that can transition into i
+        without jumping.
         :return:
         """
-        self.a_indices = np.arange((self.N + 1) * (self.N + 1) * self.L * self.L).reshape(
-            (self.N + 1, self.L, self.N + 1, self.L))
-        self.a_indexer = np.vstack([[self.a_indices[i - 2:i + 1, :, i, :]] for i in range(2, self.N + 1)])
-        self.alpha_indexer = np.arange(3 * self.L).reshape((3, self.L))[None, :] + self.L * np.tile(
-            np.vstack(np.arange(self.N - 1)), self.L)[:, None]
+        self.nbh_events = np.arange(self.N + 1)[:, None] + np.arange(-2, 1)[None, :]  # N+1 x 3
+        self.nbh_offsets = np.stack([np.arange(2, -1, -1)] * (self.N + 1))  # N+1 x 3, i - j for j in nbh(i)
+        self.nbh_mask = (self.nbh_events >= 0) & (self.nbh_events < self.N)
+        self.nbh_mask[self.N, :] = False  # break state is handled separately
+        self.nbh_events = np.clip(self.nbh_events, 0, self.N)
+
+        # alpha padded with two empty events in front, alpha_full is a strided view on it so that row i reads
+        # events i-2, i-1 and i without copying. Events outside the neighbourhood are zeroed out by a_full.
+        self.alpha_padded = np.zeros((self.N + 3, self.L))
+        row_stride, col_stride = self.alpha_padded.strides
+        self.alpha_full = np.lib.stride_tricks.as_strided(self.alpha_padded, shape=(self.N + 1, 3, self.L),
+                                                          strides=(row_stride, row_stride, col_stride),
+                                                          writeable=False)
 
     def _get_a(self):
         """
-        Use indexer to build the "a" for the transition prob term of the forward algorithm step. (Eq.21)
-        a_{(j,l),(i,l)}
+        Gather the band for the transition prob term of the forward algorithm step. (Eq.21)
+        a_{(j,l),(i,l)} for j in nbh(i), and the total transition probability into the break state.
+        Both only change with the tempo, so they are cached until parse_piece is called again.
         :return:
         """
-        first_event_a = np.zeros((3, self.L, 1, self.L))
-        first_event_a[0, :, 0, :] = self.a[0:1, :, 0, :]
-
-        second_event_a = np.zeros((3, self.L, 1, self.L))
-        second_event_a[0:2, :, 0, :] = self.a[0:2, :, 1, :]
+        if self.a_full is None:
+            self.a_full = self.a_band[self.nbh_events, self.nbh_offsets] * self.nbh_mask[:, :, None, None]
+            self.pause_state_a = np.sum(self.a_to_break, axis=0, keepdims=True)
 
-        a_rest = self.a.flatten()[self.a_indexer]
-        a_full = np.vstack(
-            ([first_event_a.reshape(3, self.L, self.L)], [second_event_a.reshape(3, self.L, self.L)], a_rest))
-        a_full[self.N, :, :, :] = 0
-        pause_state_a = self.a[:, :, self.N, :]
+        return self.a_full, self.pause_state_a
 
-        return a_full, pause_state_a
-
-    def _get_alpha(self):
+    def _get_alpha(self, lo=0, hi=None):
         """
-        Use indexer to build the "alpha" for the transition prob term of the forward algorithm step. (Eq.21)
+        Build the "alpha" for the transition prob term of the forward algorithm step. (Eq.21)
         alpha_{(t-1)(j,l)}
+        :param lo: first event that will be updated
+        :param hi: one past the last event that will be updated
         :return:
         """
-        first_event_alpha = np.zeros((3, self.L))
-        first_event_alpha[0, :] = self.alpha[0:1, :]
-
-        second_event_alpha = np.zeros((3, self.L))
-        second_event_alpha[0:2, :] = self.alpha[0:2, :]
+        hi = self.N + 1 if hi is None else hi
+        start = max(lo - 2, 0)
+        self.alpha_padded[start + 2:hi + 2] = self.alpha[start:hi]
+        pause_state_alpha = self.alpha[self.N:, :]
 
-        alpha_rest = self.alpha.flatten()[self.alpha_indexer]
-        alpha_full = np.vstack(([first_event_alpha], [second_event_alpha], alpha_rest))
-        alpha_full[self.N, :, :] = 0
+        return self.alpha_full, pause_state_alpha
 
-        pause_state_alpha = np.zeros((1, self.L))
-        pause_state_alpha[0, :] = self.alpha[self.N, :]
-
-        return alpha_full, pause_state_alpha
+    def _get_jump_prob(self, lo=0, hi=None):
+        """
+        Probability of jumping into each event from anywhere outside its neighbourhood. Since the jump
+        transitions are rank-1 this is the total outflow minus the outflow of the neighbourhood. (Eq.12)
+        alpha is assumed to be 0 outside of [lo, hi).
+        :param lo: first event to compute
+        :param hi: one past the last event to compute
+        :return: hi - lo vector, 0 for the break state.
+        """
+        hi = self.N + 1 if hi is None else hi
+        start = max(lo - 2, 0)
+        outflow = self.alpha[start:hi, 0] * self.jump_out[start:hi]
+        total = np.sum(outflow)
+        cumulative = np.concatenate((np.zeros(3), np.cumsum(outflow)))
+        nbh_outflow = cumulative[3:] - cumulative[:-3]
+        return self.jump_in[lo:hi] * (total - nbh_outflow[lo - start:])
 
     def b(self, y_t):
         """
         Probability of observing audio feature y_t at bottom state l of top state i
-        :return: L x N matrix representing probability of observing current observation for eacn of the N events.
+        The 13 pitch densities are evaluated once and mapped onto the events through pitch_weights.
+        :return: N x L matrix representing probability of observing current observation for eacn of the N events.
+        """
+        return self._get_obs_prob(self._get_pitch_pdf(y_t))
+
+    def _get_pitch_pdf(self, y_t):
+        """
+        Density of audio feature y_t under each of the 13 pitch gaussians.
+        :param y_t: 12 dimensional chroma vector, or T x 12 matrix of them
+        :return: 13 vector (T x 13 for a matrix), index 0 is silence.
         """
+        if self.emissions.is_diagonal:
+            pdf = MathHelper.diagonal_norm_pdf(y_t, self.mu_mat, self.emissions.inv_var, self.emissions.log_norm)
+            return np.clip(pdf, 0, 0.999)
 
-        y_t = np.array([[y_t] * self.NUM_PITCHES] * (self.N + 1))
-        pdf = np.clip(MathHelper.multivariate_norm_pdf(y_t, self.mu_mat, self.det_mat, self.inv_mat), 0, 0.999)
-        pdf[self.N] = np.clip(pdf[self.N], 0, 0.001)
-        return np.sum(np.stack([pdf] * self.L, axis=2) * self.pitch_weights, axis=1)
+        y_t = np.stack([y_t] * self.NUM_PITCHES, axis=-2)
+        pdf = MathHelper.multivariate_norm_pdf(y_t, self.mu_mat, self.det_mat, self.inv_mat)
+        return np.clip(pdf.reshape(y_t.shape[:-1]), 0, 0.999)
+
+    def _get_obs_prob(self, pdf):
+        """
+        Map pitch densities onto the score events.
+        :param pdf: 13 vector of pitch densities, or T x 13 matrix of them
+        :return: N+1 x L matrix (T x N+1 x L for a matrix)
+        """
+        obs_prob = np.tensordot(pdf, self.pitch_weights, axes=(-1, 1))
+        obs_prob[..., self.N, :] = np.clip(pdf, 0, 0.001) @ self.pitch_weights[self.N]
+        return obs_prob
 
     def _get_weight(self, k, p_i):
         """
@@ -295,28 +329,337 @@ class Model:
         Updates belief state of what the current music event is
         :return:
         """
+        if self.t > 0 and self.beam_window is not None:
+            return self._forward_step_beam(self._get_pitch_pdf(obs))
+        return self._forward_step(self.b(obs))
+
+    def _forward_step(self, obs_prob):
+        """
+        Forward algorithm step over the whole score
+        :param obs_prob: N+1 x L emission probabilities of the current observation
+        :return:
+        """
         if self.t == 0:
-            self.alpha = self.b(obs) * self.pi
+            self.alpha = obs_prob * self.pi
             self.t += 1
-            return np.unravel_index(np.argmax(self.alpha), self.alpha.shape), np.max(self.alpha)
         else:
-            # Get emission probability
-            obs_prob = self.b(obs)
-
             # Build neighborhooded alpha and a.
             a_full, pause_state_a = self._get_a()
             alpha_full, pause_state_alpha = self._get_alpha()
 
-            # calculate probability of making transition and probability of going through the break state
-            trans_prob = np.sum(np.stack([alpha_full] * self.L, axis=3) * a_full, axis=(1, 2))
-            trans_pause = np.sum((np.stack([pause_state_alpha] * self.L, axis=2) * pause_state_a), axis=(0, 1))
-            stop_state_prob = np.stack([np.sum(self.alpha[self.N, :] * self.a[self.N, :, 0, :], axis=1)] * (self.N + 1))
+            # calculate probability of making transition, jumping and going through the break state
+            trans_prob = np.einsum('ijk,ijkl->il', alpha_full, a_full)
+            trans_prob[:, 0] += self._get_jump_prob()
+            trans_pause = np.sum(pause_state_alpha[:, :, None] * pause_state_a, axis=(0, 1))
+            stop_state_prob = np.sum(self.alpha[self.N, :, None] * self.a_from_break, axis=1)
             trans_prob += stop_state_prob
             trans_prob[self.N, :] = trans_pause
 
             # update alpha
             self.alpha = obs_prob * trans_prob
-            return np.unravel_index(np.argmax(self.alpha), self.alpha.shape), np.max(self.alpha)
+
+        self._prune_alpha()
+        self._normalize_alpha()
+        return np.unravel_index(np.argmax(self.alpha), self.alpha.shape), np.max(self.alpha)
+
+    def _forward_step_beam(self, pdf):
+        """
+        Forward algorithm step restricted to the events in the beam window, which can move at most two events
+        ahead, and the break state. alpha stays 0 for every other event.
+        :param pdf: 13 vector of pitch densities of the current observation
+        :return:
+        """
+        lo, hi = self.beam_window
+        hi = min(hi + 2, self.N)
+        events = np.r_[lo:hi, self.N]
+
+        # Get emission probability
+        obs_prob = np.tensordot(pdf, self.pitch_weights[lo:hi], axes=(0, 1))
+        pause_obs_prob = np.clip(pdf, 0, 0.001) @ self.pitch_weights[self.N]
+
+        # Build neighborhooded alpha and a.
+        a_full, pause_state_a = self._get_a()
+        alpha_full, pause_state_alpha = self._get_alpha(lo, hi)
+
+        # calculate probability of making transition, jumping and going through the break state
+        trans_prob = np.einsum('ijk,ijkl->il', alpha_full[lo:hi], a_full[lo:hi])
+        trans_prob[:, 0] += self._get_jump_prob(lo, hi)
+        trans_pause = np.sum(pause_state_alpha[:, :, None] * pause_state_a, axis=(0, 1))
+        trans_prob += np.sum(self.alpha[self.N, :, None] * self.a_from_break[lo:hi], axis=1)
+
+        # update alpha
+        self.alpha[lo:hi] = obs_prob * trans_prob
+        self.alpha[self.N] = pause_obs_prob * trans_pause
+
+        self._prune_alpha(lo, hi)
+        self._normalize_alpha(events)
+        alpha = self.alpha[events]
+        event, l = np.unravel_index(np.argmax(alpha), alpha.shape)
+        return (events[event], l), alpha[event, l]
+
+    def _prune_alpha(self, lo=0, hi=None):
+        """
+        Zero out the events in [lo, hi) that fall outside the beam and record the new beam window.
+        If the break state is at least as likely as the best event the follower is lost, so nothing is pruned
+        and the next frame goes back to evaluating the whole score, letting the break state and jumps
+        bring the follower back.
+        :param lo: first event updated this frame
+        :param hi: one past the last event updated this frame
+        :return: None
+        """
+        if self.beam_width is None and self.beam_threshold is None:
+            return
+
+        hi = self.N if hi is None else hi
+        event_prob = np.sum(self.alpha[lo:hi], axis=1)
+        peak = np.argmax(event_prob)
+        if event_prob[peak] <= np.max(self.alpha[self.N]):
+            self.beam_window = None
+            return
+
+        keep_lo, keep_hi = 0, hi - lo
+        if self.beam_threshold is not None:
+            keep = np.flatnonzero(event_prob >= min(self.beam_threshold * np.sum(event_prob), event_prob[peak]))
+            keep_lo, keep_hi = keep[0], keep[-1] + 1
+        if self.beam_width is not None:
+            keep_lo, keep_hi = max(keep_lo, peak - self.beam_width), min(keep_hi, peak + self.beam_width + 1)
+
+        self.alpha[lo:lo + keep_lo] = 0
+        self.alpha[lo + keep_hi:hi] = 0
+        self.beam_window = (lo + keep_lo, lo + keep_hi)
+
+    def _normalize_alpha(self, events=slice(None)):
+        """
+        Rescale alpha to sum to one when running in scaled mode, so that it never underflows.
+        The scale factor is the likelihood of the current observation given the previous ones.
+        Unscaled alpha is only scaled up by UNSCALED_RESCALE once it gets close to underflowing, and no likelihood is
+        tracked.
+        :param events: events holding all of the probability mass
+        :return: None
+        """
+        if not self.scaled:
+            if np.max(self.alpha[events]) < self.UNSCALED_THRESHOLD:
+                self.alpha[events] *= self.UNSCALED_RESCALE
+            return
+
+        scale = np.sum(self.alpha[events])
+        if scale > 0:
+            self.alpha[events] /= scale
+            self.log_likelihood = np.log(scale)
+        else:
+            self.log_likelihood = -np.inf
+        self.total_log_likelihood += self.log_likelihood
+
+    def set_parameters(self, **parameters):
+        """
+        Override model constants and rebuild everything that depends on them. Useful for tuning.
+        :param parameters: any of C, s, r, p_del, pause_self_loop and recording_speed
+        :return: None
+        """
+        for name, value in parameters.items():
+            if name not in ("C", "s", "r", "p_del", "pause_self_loop", "recording_speed"):
+                raise ValueError(f"Unknown model parameter {name}")
+            setattr(self, name, value)
+
+        for a in (self.a_band, self.a_to_break, self.a_from_break, self.jump_out, self.jump_in, self.pi, self.e):
+            a[:] = 0
+        self.initialize_initial_probabilities()
+        self.initialize_transition_matrix()
+        self.initialize_pitch_weights()
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the forward algorithm variables so that following starts again from the beginning of the piece.
+        :return: None
+        """
+        self.t = 0
+        self.alpha = np.zeros((self.N + 1, self.L))
+        self.beam_window = None
+        self.log_likelihood = 0.0
+        self.total_log_likelihood = 0.0
+
+    def next_observations(self, observations):
+        """
+        Several iterations of the forward algorithm, e.g. to catch up on a backlog of observations.
+        Emissions for all of them are computed as one block.
+        :param observations: T x 12 matrix of chroma vectors
+        :return: list of (current state, probability) for every observation
+        """
+        pdf = self._get_pitch_pdf(np.asarray(observations, dtype=float))
+        return list(self._forward_steps(pdf, self._get_obs_prob(pdf)))
+
+    def _forward_steps(self, pdf, obs_prob):
+        """
+        Generator running the forward algorithm over a block of observations.
+        :param pdf: T x 13 pitch densities
+        :param obs_prob: T x N+1 x L emission probabilities
+        :return: yields (current state, probability) after every observation
+        """
+        for t in range(len(pdf)):
+            if self.t > 0 and self.beam_window is not None:
+                yield self._forward_step_beam(pdf[t])
+            else:
+                yield self._forward_step(obs_prob[t])
+
+    def align(self, observations, viterbi=False):
+        """
+        Align a whole recording to the score offline, from the beginning of the piece. Emissions for every frame are
+        computed as one block, the recursion writes every frame into one preallocated array and the events of all
+        frames are picked at the end. Always runs over the whole score, beam pruning is only used by
+        next_observation.
+        :param observations: T x 12 matrix of chroma vectors
+        :param viterbi: If True return the most likely event sequence instead of the most likely event per frame.
+        Only the Viterbi recursion runs then, not the forward algorithm.
+        :return: T vector of events, T vector of the probability of that event: the filtered posterior for the
+        forward algorithm, its share of the Viterbi probabilities of the frame for viterbi
+        """
+        self.reset()
+        pdf = self._get_pitch_pdf(np.asarray(observations, dtype=float))
+        obs_prob = self._get_obs_prob(pdf)
+        num_frames = len(obs_prob)
+
+        if viterbi:
+            path, deltas = self._viterbi(obs_prob)
+            event_probs = np.sum(deltas, axis=2)
+            probs = event_probs[np.arange(num_frames), path] / np.sum(event_probs, axis=1)
+            return path, probs
+
+        alphas = self._forward_block(obs_prob).reshape(num_frames, -1)
+        states = np.argmax(alphas, axis=1)
+        return states // self.L, alphas[np.arange(num_frames), states]
+
+    def _forward_block(self, obs_prob):
+        """
+        Forward algorithm over a block of emissions from the beginning of the piece, leaving the model at the last
+        frame like next_observation would.
+        :param obs_prob: T x N+1 x L emission probabilities
+        :return: T x N+1 x L alpha of every frame
+        """
+        num_frames = len(obs_prob)
+        a_full, pause_state_a = self._get_a()
+
+        # Every frame is padded with two empty events in front and nbh[t] reads events i-2, i-1 and i of frame t for
+        # every event i without copying, like alpha_full.
+        padded = np.zeros((num_frames, self.N + 3, self.L))
+        frame_stride, row_stride, col_stride = padded.strides
+        nbh = np.lib.stride_tricks.as_strided(padded, shape=(num_frames, self.N + 1, 3, self.L),
+                                              strides=(frame_stride, row_stride, row_stride, col_stride),
+                                              writeable=False)
+        alphas = padded[:, 2:]
+        log_likelihoods = np.zeros(num_frames)
+        cumulative = np.zeros(self.N + 4)  # cumulative jump outflow with 3 leading zeros, see _get_jump_prob
+
+        for t in range(num_frames):
+            alpha = alphas[t]
+            if t == 0:
+                np.multiply(obs_prob[0], self.pi, out=alpha)
+            else:
+                prev = alphas[t - 1]
+                trans_prob = np.einsum('ijk,ijkl->il', nbh[t - 1], a_full)
+                outflow = prev[:, 0] * self.jump_out
+                np.cumsum(outflow, out=cumulative[3:])
+                trans_prob[:, 0] += self.jump_in * (np.sum(outflow) - (cumulative[3:] - cumulative[:-3]))
+                trans_prob += np.sum(prev[self.N, :, None] * self.a_from_break, axis=1)
+                trans_prob[self.N, :] = np.sum(prev[self.N:, :, None] * pause_state_a, axis=(0, 1))
+                np.multiply(obs_prob[t], trans_prob, out=alpha)
+
+            if self.scaled:
+                scale = np.sum(alpha)
+                if scale > 0:
+                    alpha /= scale
+                    log_likelihoods[t] = np.log(scale)
+                else:
+                    log_likelihoods[t] = -np.inf
+            elif np.max(alpha) < self.UNSCALED_THRESHOLD:
+                alpha *= self.UNSCALED_RESCALE
+
+        self.t = num_frames
+        self.alpha = alphas[-1].copy()
+        if self.scaled:
+            self.log_likelihood = log_likelihoods[-1]
+            self.total_log_likelihood += np.sum(log_likelihoods)
+        return alphas
+
+    def _viterbi(self, obs_prob):
+        """
+        Most likely event sequence for a block of emissions. Same transitions as the forward algorithm with the
+        sums replaced by maxes, delta is rescaled by its max every frame so it never underflows.
+        :param obs_prob: T x N+1 x L emission probabilities
+        :return: T vector of events, T x N+1 x L rescaled delta of every frame
+        """
+        num_frames = len(obs_prob)
+        num_states = (self.N + 1) * self.L
+        a_full, pause_state_a = self._get_a()
+        events = np.arange(self.N + 1)[:, None]
+        deltas = np.zeros((num_frames, self.N + 1, self.L))
+        backpointers = np.zeros((num_frames, num_states), dtype=int)
+
+        deltas[0] = obs_prob[0] * self.pi
+        deltas[0] /= np.max(deltas[0])
+        for t in range(1, num_frames):
+            delta = deltas[t - 1]
+
+            # neighbourhood, flattened over (j, l') so that the argmax gives the previous event and bottom state
+            nbh_prob = (delta[self.nbh_events][:, :, :, None] * a_full).reshape(self.N + 1, 3 * self.L, self.L)
+            nbh_best = np.argmax(nbh_prob, axis=1)
+            best_prob = np.max(nbh_prob, axis=1)
+            best_prev = self.nbh_events[events, nbh_best // self.L] * self.L + nbh_best % self.L
+
+            # out of the break state
+            break_prob = delta[self.N, :, None] * self.a_from_break
+            break_best = np.argmax(break_prob, axis=1)
+            break_prob = np.max(break_prob, axis=1)
+            use_break = break_prob > best_prob
+            best_prob = np.where(use_break, break_prob, best_prob)
+            best_prev = np.where(use_break, self.N * self.L + break_best, best_prev)
+
+            # jumps from the best source outside of nbh(i)
+            jump_prob, jump_prev = self._get_jump_max(delta)
+            use_jump = jump_prob > best_prob[:, 0]
+            best_prob[:, 0] = np.where(use_jump, jump_prob, best_prob[:, 0])
+            best_prev[:, 0] = np.where(use_jump, jump_prev * self.L, best_prev[:, 0])
+
+            # staying in the break state
+            pause_prob = delta[self.N, :, None] * pause_state_a[0]
+            best_prob[self.N] = np.max(pause_prob, axis=0)
+            best_prev[self.N] = self.N * self.L + np.argmax(pause_prob, axis=0)
+
+            np.multiply(obs_prob[t], best_prob, out=deltas[t])
+            deltas[t] /= max(np.max(deltas[t]), np.finfo(float).tiny)
+            backpointers[t] = best_prev.reshape(num_states)
+
+        path = np.zeros(num_frames, dtype=int)
+        state = np.argmax(deltas[-1])
+        for t in range(num_frames - 1, -1, -1):
+            path[t] = state // self.L
+            state = backpointers[t, state]
+        return path, deltas
+
+    def _get_jump_max(self, delta):
+        """
+        Max-product counterpart of _get_jump_prob. The best source outside nbh(i) is the best one before i-2 or the
+        best one after i, both read from running maxes over the events.
+        :param delta: N+1 x L viterbi probabilities of the previous frame
+        :return: N+1 vector of the best jump probability into each event, N+1 vector of the event it jumps from
+        """
+        outflow = delta[:self.N, 0] * self.jump_out[:self.N]
+        indices = np.arange(self.N)
+
+        # best source at or before each event, and at or after it
+        prefix_max = np.maximum.accumulate(outflow)
+        prefix_arg = np.maximum.accumulate(np.where(outflow == prefix_max, indices, 0))
+        reverse_max = np.maximum.accumulate(outflow[::-1])
+        suffix_max = reverse_max[::-1]
+        suffix_arg = (self.N - 1 - np.maximum.accumulate(np.where(outflow[::-1] == reverse_max, indices, 0)))[::-1]
+
+        before, before_arg = np.zeros(self.N + 1), np.zeros(self.N + 1, dtype=int)
+        before[3:], before_arg[3:] = prefix_max[:self.N - 2], prefix_arg[:self.N - 2]
+        after, after_arg = np.zeros(self.N + 1), np.zeros(self.N + 1, dtype=int)
+        after[:self.N - 1], after_arg[:self.N - 1] = suffix_max[1:], suffix_arg[1:]
+
+        use_after = after > before
+        return self.jump_in * np.where(use_after, after, before), np.where(use_after, after_arg, before_arg)
 
     def update_tempo(self):
         """
@@ -325,10 +668,12 @@ class Model:
         :return:
         """
         self.parse_piece()
-        next_state_prob = 1 - self.s - np.diag(self.a[:, 0, :, 0]) - np.pad(np.diag(self.a[:, 0, 2:, 0]), (0, 2),
-                                                                            'constant')
+        skip_prob = np.zeros(self.N + 1)
+        skip_prob[:self.N - 2] = self.a_band[:self.N - 2, 2, 0, 0]
+        skip_prob[self.N - 2] = self.a_to_break[self.N - 2, 0, 0]
+        next_state_prob = 1 - self.s - self.a_band[:, 0, 0, 0] - skip_prob
         next_state_prob = self.e * np.stack([next_state_prob] * self.L, axis=1) * np.stack([self.pi[:, 0]] * self.L,
                                                                                            axis=1)
-        np.fill_diagonal(self.a[:, 0, 1:, 0], next_state_prob[:, 0])
-        if self.L > 1:
-            np.fill_diagonal(self.a[:, 1, 1:, 0], next_state_prob[:, 1])
+        # i+1 of the last event is the break state
+        self.a_band[:self.N - 1, 1, :, 0] = next_state_prob[:self.N - 1, :]
+        self.a_to_break[self.N - 1, :, 0] = next_state_prob[self.N - 1, :]
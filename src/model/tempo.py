@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -36,6 +35,8 @@ class KalmanFilter:
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     kalman_filter = KalmanFilter(60)
 
     true_tempos = [60, 65, 62, 63, 64, 65, 60, 65, 65, 66, 67, 68, 68, 68, 68, 68, 68, 68, 70]
@@ -1,5 +1,7 @@
 from enum import Enum
 
+import numpy as np
+
 
 class Note:
     def __init__(self, pitch, duration, is_note_start=False, is_note_end=False):
@@ -66,3 +68,96 @@ class Duration:
 
     def __repr__(self):
         return self.__str__()
+
+
+class NoteView:
+    """
+    Read only Note backed by one row of a NoteTrack. Only holds a reference to the track and an index, so a score can
+    hand out notes without keeping an object per subdivision around. Two views of the same row compare equal.
+    """
+    __slots__ = ("track", "index")
+
+    def __init__(self, track, index):
+        self.track = track
+        self.index = index
+
+    @property
+    def pitch(self):
+        return self.track.get_pitch(self.index)
+
+    @property
+    def duration(self):
+        return float(self.track.duration[self.index])
+
+    @property
+    def is_note_start(self):
+        return bool(self.track.is_note_start[self.index])
+
+    @property
+    def is_note_end(self):
+        return bool(self.track.is_note_end[self.index])
+
+    def __eq__(self, other):
+        return isinstance(other, NoteView) and self.track is other.track and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.track), self.index))
+
+    def __str__(self):
+        return "<{0}, {1}>".format(self.pitch, self.duration)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class NoteTrack:
+    """
+    Sequence of notes stored as parallel arrays. Pitches are Pitch values for a solo track and midi numbers for an
+    accompaniment track, -1 is a rest in both. Indexing returns NoteViews.
+    """
+
+    def __init__(self, pitch, duration, is_note_start, is_note_end, is_solo=True):
+        """
+        :param pitch: int array of pitches
+        :param duration: float array of durations in beats
+        :param is_note_start: bool array, whether each event is the first subdivision of its note
+        :param is_note_end: bool array, whether each event is the last subdivision of its note
+        :param is_solo: whether pitches are Pitch values or midi numbers
+        """
+        self.pitch = np.asarray(pitch, dtype=np.int16)
+        self.duration = np.asarray(duration, dtype=np.float32)
+        self.is_note_start = np.asarray(is_note_start, dtype=bool)
+        self.is_note_end = np.asarray(is_note_end, dtype=bool)
+        self.is_solo = is_solo
+
+    @staticmethod
+    def from_notes(notes, is_solo=True):
+        """
+        :param notes: list of Notes
+        :param is_solo: whether pitches are Pitch values or midi numbers
+        :return: NoteTrack
+        """
+        return NoteTrack([note.pitch.value if isinstance(note.pitch, Pitch) else note.pitch for note in notes],
+                         [getattr(note.duration, "value", note.duration) for note in notes],
+                         [note.is_note_start for note in notes], [note.is_note_end for note in notes], is_solo)
+
+    def get_pitch(self, index):
+        pitch = int(self.pitch[index])
+        if self.is_solo:
+            return Pitch(pitch)
+        return Pitch.REST if pitch == Pitch.REST.value else pitch
+
+    def __len__(self):
+        return len(self.pitch)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [NoteView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("NoteTrack index out of range")
+        return NoteView(self, index)
+
+    def __iter__(self):
+        return (NoteView(self, i) for i in range(len(self)))
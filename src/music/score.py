@@ -1,11 +1,14 @@
+import hashlib
+import logging
+import os
 from abc import abstractmethod
 from enum import Enum
 
 import numpy as np
-import pretty_midi
 
-from src.interface.midi import MidiClient
-from src.music.note import Note, Pitch, Duration
+from src.music.note import Note, NoteTrack, Pitch, Duration
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 class ScoreBuilder:
@@ -14,6 +17,8 @@ class ScoreBuilder:
     """
 
     def __init__(self, filename, sub_beat):
+        from src.interface.midi import MidiClient  # music21 is slow to import, only needed on a cache miss
+
         self.product = None
         self.reset()
         self.midi_client = MidiClient()
@@ -108,6 +113,98 @@ class ScoreBuilder:
         return product
 
 
+class ScoreCache:
+    """
+    On disk cache of the Scores built by ScoreBuilder, keyed by the hash of the midi file and the sub beat.
+    Scores are stored as the arrays of a CompactScore in an npz file, so loading one needs neither music21 nor the
+    subdivision of every track.
+    """
+    VERSION = 2  # bump when the layout of the cache files or ScoreBuilder's output changes
+
+    def __init__(self, cache_dir=f"{THIS_DIR}/../../res/cache/scores"):
+        self.cache_dir = cache_dir
+
+    def get_score(self, filename, sub_beat):
+        """
+        Load the score for the midi file from the cache, building and caching it on a miss.
+        :param filename: midi file
+        :param sub_beat: Duration to subdivide into
+        :return: CompactScore
+        """
+        path = self.get_path(filename, sub_beat)
+        if os.path.exists(path):
+            try:
+                return self.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable score cache {path}: {e}")
+
+        score = CompactScore.from_score(ScoreBuilder(filename, sub_beat).build())
+        try:
+            self.save(score, path)
+        except OSError as e:
+            logging.warning(f"Could not write score cache {path}: {e}")
+        return score
+
+    def get_path(self, filename, sub_beat):
+        """
+        :param filename: midi file
+        :param sub_beat: Duration to subdivide into
+        :return: path of the cache file for this midi file content and sub beat
+        """
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest[:32]}_{sub_beat.value}_v{self.VERSION}.npz")
+
+    @staticmethod
+    def save(score, path):
+        """
+        Write a Score built by ScoreBuilder to path.
+        :param score: Score or CompactScore
+        :param path: npz file
+        :return: None
+        """
+        if not isinstance(score, CompactScore):
+            score = CompactScore.from_score(score)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            title=np.array(score.title),
+            sub_beat=np.array(score.sub_beat.value),
+            N=np.array(score.N),
+            true_note_mapping=score.true_note_mapping,
+            **{f"{name}_{field}": getattr(track, field)
+               for name, track in [("notes", score.notes), ("solo", score.subdivided_notes)] +
+               [(f"part{i}", part) for i, part in enumerate(score.parts)]
+               for field in ("pitch", "duration", "is_note_start", "is_note_end")},
+        )
+        os.replace(tmp_path, path)  # readers never see a partially written file
+
+    @staticmethod
+    def load(path):
+        """
+        Read a Score written by save.
+        :param path: npz file
+        :return: CompactScore
+        """
+        def track(data, name, is_solo=True):
+            return NoteTrack(data[f"{name}_pitch"], data[f"{name}_duration"], data[f"{name}_is_note_start"],
+                             data[f"{name}_is_note_end"], is_solo)
+
+        with np.load(path) as data:
+            num_parts = sum(1 for key in data.files if key.startswith("part") and key.endswith("_pitch"))
+            return CompactScore(
+                track(data, "solo"),
+                notes=track(data, "notes"),
+                parts=[track(data, f"part{i}", is_solo=False) for i in range(num_parts)],
+                true_note_mapping=data["true_note_mapping"],
+                N=int(data["N"]),
+                sub_beat=Duration(float(data["sub_beat"])),
+                title=str(data["title"]),
+            )
+
+
 class ScoreFactory:
     @staticmethod
     def get_score(title):
@@ -116,7 +213,7 @@ class ScoreFactory:
         elif title == Pieces.TestPachabels:
             return PachabelScore()
         elif title == Pieces.ShortPachabels:
-            return ScoreBuilder('../../res/midi/Pachabels/short_pachabels.mid', Duration(0.25)).build()
+            return ScoreCache().get_score('../../res/midi/Pachabels/short_pachabels.mid', Duration(0.25))
         else:
             return None
 
@@ -158,6 +255,114 @@ class Score:
     def get_accompaniment(self, event_num):
         return self.accompaniment[event_num]
 
+    def set_accompaniment_line(self, pitches, duration):
+        """
+        Set a single accompaniment line of one note per event, for the hard coded scores which have no parts.
+        Notes are built like ScoreBuilder's so AccompanimentService can play them.
+        :param pitches: midi number of the note at every event, None for nothing
+        :param duration: Duration of an event
+        :return: None
+        """
+        self.accompaniment = [{Note(pitch, duration, is_note_start=True, is_note_end=True)} if pitch is not None
+                              else set() for pitch in pitches]
+
+    def set_note_mapping(self):
+        """
+        Make every subdivided event a note of its own, for the hard coded scores which only list subdivided notes.
+        :return: None
+        """
+        self.notes = [Note(note.pitch, note.duration.value) for note in self.subdivided_notes]
+        # The model moves on to event N once the last note is over, it still belongs to the last note
+        self.true_note_mapping = {event: min(event, self.N - 1) for event in range(self.N + 1)}
+
+    def get_solo_pitches(self):
+        """
+        :return: int array of the Pitch value of every subdivided solo event
+        """
+        return np.array([note.pitch.value for note in self.subdivided_notes])
+
+    def get_part_pitches(self, event):
+        """
+        :param event: subdivided event
+        :return: int array of the midi number each accompaniment part plays at event, -1 for a rest
+        """
+        if self.parts is None:
+            # The hard coded scores have a single accompaniment line instead of parts, see set_accompaniment
+            notes = self.accompaniment[event] if event < len(self.accompaniment) else ()
+            return np.array([next((note.pitch for note in notes), Pitch.REST.value)])
+        return np.array([note.pitch if note.pitch != Pitch.REST else Pitch.REST.value for note in self.parts[:, event]])
+
+
+class CompactScore(Score):
+    """
+    Score stored as parallel arrays instead of a Note object per subdivision. subdivided_notes, notes and every part
+    are NoteTracks, which hand out NoteViews on indexing, and the accompaniment is read straight from the part arrays.
+    """
+
+    def __init__(self, subdivided_notes, notes=None, parts=(), true_note_mapping=None, N=None, sub_beat=Duration(1),
+                 tempo=None, title="", accompaniment=None):
+        """
+        :param subdivided_notes: NoteTrack of the solo part, one row per event
+        :param notes: NoteTrack of the solo part, one row per note
+        :param parts: list of NoteTracks of the accompaniment parts, each as long as subdivided_notes
+        :param true_note_mapping: int array mapping each event to its note
+        :param N: number of events, len(subdivided_notes) if None
+        :param sub_beat: Duration of an event
+        :param tempo: tempo in bpm
+        :param title: title of the piece
+        :param accompaniment: list of sets of Notes, only used when there are no parts
+        """
+        super().__init__()
+        self.title = title
+        self.subdivided_notes = subdivided_notes
+        self.notes = notes
+        self.parts = list(parts)
+        self.true_note_mapping = None if true_note_mapping is None else np.asarray(true_note_mapping, dtype=np.int32)
+        self.N = len(subdivided_notes) if N is None else N
+        self.sub_beat = sub_beat
+        self.tempo = tempo
+        self.accompaniment = accompaniment
+
+        # parts x events, what MessageBuilder sends the headset
+        self.parts_pitch = np.stack([part.pitch for part in self.parts]) if self.parts else np.zeros((0, 0), np.int16)
+
+    @staticmethod
+    def from_score(score):
+        """
+        Convert a Score made of Note objects.
+        :param score: Score
+        :return: CompactScore
+        """
+        mapping = score.true_note_mapping
+        return CompactScore(
+            NoteTrack.from_notes(score.subdivided_notes),
+            notes=None if score.notes is None else NoteTrack.from_notes(score.notes),
+            parts=[] if score.parts is None else [NoteTrack.from_notes(part, is_solo=False) for part in score.parts],
+            true_note_mapping=None if mapping is None else [mapping[i] for i in range(len(mapping))],
+            N=score.N,
+            sub_beat=score.sub_beat,
+            tempo=score.tempo,
+            title=score.title,
+            accompaniment=score.accompaniment if score.parts is None else None,
+        )
+
+    def get_true_note_event(self, event):
+        return int(self.true_note_mapping[event]) + 1
+
+    def get_accompaniment(self, event_num):
+        if not self.parts:
+            return self.accompaniment[event_num]
+        return {part[event_num] for part in self.parts}
+
+    def get_solo_pitches(self):
+        return self.subdivided_notes.pitch
+
+    def get_part_pitches(self, event):
+        if not self.parts:
+            notes = self.accompaniment[event] if event < len(self.accompaniment) else ()
+            return np.array([next((note.pitch for note in notes), Pitch.REST.value)])
+        return self.parts_pitch[:, event]
+
 
 class PachabelScore(Score):
     """
@@ -169,6 +374,7 @@ class PachabelScore(Score):
         self.title = "Pachabel's Canon in D"
         self.N = 0
         self.set_notes()
+        self.set_note_mapping()
         self.set_tempo()
         self.set_accompaniment()
         self.sub_beat = Duration(0.5)
@@ -214,7 +420,10 @@ class PachabelScore(Score):
                          'B2', 'F#4', 'B3', 'D4', 'F#2', 'C#3', 'F#3', 'A3',
                          'G2', 'D3', 'G3', 'B3', 'D2', 'A2', 'D3', 'F#3',
                          'G2', 'D3', 'G3', 'B3', 'A2', 'E3', 'A3', 'C#4']
-        self.accompaniment = [{pretty_midi.note_name_to_number(note)} if note != '' else '' for note in accompaniment]
+        import pretty_midi
+
+        self.set_accompaniment_line([pretty_midi.note_name_to_number(note) if note != '' else None
+                                     for note in accompaniment], Duration(0.5))
 
     def set_tempo(self):
         self.tempo = 60
@@ -230,6 +439,7 @@ class TwinkleTwinkleScore(Score):
         self.title = "Twinkle Twinkle Little Star"
         self.N = 0
         self.set_notes()
+        self.set_note_mapping()
         self.set_tempo()
         self.set_accompaniment()
         self.sub_beat = Duration(1.0)
@@ -262,7 +472,53 @@ class TwinkleTwinkleScore(Score):
     def set_accompaniment(self):
         accompaniment = ['', 'A3', 'A3', 'F#4', 'F#4', 'G4', 'G4', 'F#4', 'F#4', 'E4', 'E4', 'D4', 'D4', 'A3', 'C#4',
                          'D4', 'D4']
-        self.accompaniment = [{pretty_midi.note_name_to_number(note)} if note != '' else '' for note in accompaniment]
+        import pretty_midi
+
+        self.set_accompaniment_line([pretty_midi.note_name_to_number(note) if note != '' else None
+                                     for note in accompaniment], Duration(1.0))
 
     def get_accompaniment(self, event_num):
         return self.accompaniment[event_num]
+
+
+class SyntheticScore(Score):
+    """
+    Randomly generated solo line of a given number of events, meant for benchmarking.
+    """
+
+    def __init__(self, num_events, sub_beat=Duration(1.0), tempo=60, seed=0):
+        super().__init__()
+        self.title = f"Synthetic Score ({num_events} events)"
+        self.N = 0
+        self.sub_beat = sub_beat
+        self.num_events = num_events
+        self.random_state = np.random.RandomState(seed)
+        self.set_notes()
+        self.set_tempo(tempo)
+        self.set_accompaniment()
+
+    def set_notes(self):
+        pitches = [pitch for pitch in Pitch]
+        self.notes = [Note(Pitch.REST, self.sub_beat.value)]
+        self.subdivided_notes = [Note(Pitch.REST, self.sub_beat, is_note_start=True, is_note_end=True)]
+        self.true_note_mapping = {0: 0}
+
+        while len(self.subdivided_notes) < self.num_events:
+            pitch = pitches[self.random_state.randint(len(pitches))]
+            num_subdivisions = min(self.random_state.randint(1, 5), self.num_events - len(self.subdivided_notes))
+            subdivided_note = [Note(pitch, self.sub_beat) for _ in range(num_subdivisions)]
+            subdivided_note[0].is_note_start = True
+            subdivided_note[-1].is_note_end = True
+
+            for _ in subdivided_note:
+                self.true_note_mapping[len(self.true_note_mapping)] = len(self.notes)
+            self.notes.append(Note(pitch, num_subdivisions * self.sub_beat.value))
+            self.subdivided_notes.extend(subdivided_note)
+        self.N = len(self.subdivided_notes)
+
+    def set_tempo(self, tempo=60):
+        self.tempo = tempo
+
+    def set_accompaniment(self):
+        self.set_accompaniment_line([note.pitch.value + 48 if note.pitch != Pitch.REST else None
+                                     for note in self.subdivided_notes], self.sub_beat)
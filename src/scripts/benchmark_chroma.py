@@ -0,0 +1,49 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+sys.path.append("../../")
+
+from src.interface.audio import AudioClient, StreamingChroma
+
+
+def synthesize_note(midi_number, num_samples, sample_rate, num_harmonics=4, noise=0.01):
+    """
+    Harmonic tone with a little noise, a rough stand-in for a bowed string.
+    """
+    t = np.arange(num_samples) / sample_rate
+    frequency = 440 * 2 ** ((midi_number - 69) / 12)
+    tone = sum(0.5 / h * np.sin(2 * np.pi * frequency * h * t) for h in range(1, num_harmonics + 1))
+    return (tone + noise * np.random.randn(num_samples)).astype(np.float32)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time per-block chroma_cqt against the streaming chroma extractor, '
+                                                 'see test/unit/test_audio.py for how closely they agree')
+    parser.add_argument('--blocks', metavar='blocks', type=int, default=8, help='Blocks per synthesized note')
+    parser.add_argument('--lowest', metavar='lowest', type=int, default=55, help='Lowest midi note (G3)')
+    parser.add_argument('--highest', metavar='highest', type=int, default=91, help='Highest midi note')
+    args = parser.parse_args()
+
+    audio_client = AudioClient()
+    start = time.perf_counter()
+    streaming_chroma = StreamingChroma(audio_client.sample_rate, audio_client.blocksize)
+    print(f"Operator built in {time.perf_counter() - start:.3f}s")
+
+    librosa_times, streaming_times = [], []
+    for midi_number in range(args.lowest, args.highest + 1):
+        audio = synthesize_note(midi_number, args.blocks * audio_client.blocksize, audio_client.sample_rate)
+        for block in np.split(audio, args.blocks):
+            start = time.perf_counter()
+            audio_client.extract_chroma(block)
+            librosa_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            streaming_chroma.process(block)
+            streaming_times.append(time.perf_counter() - start)
+
+    print(f"{'extractor':>10} {'median (ms)':>12} {'p99 (ms)':>10}")
+    for name, times in [("chroma_cqt", librosa_times), ("streaming", streaming_times)]:
+        print(f"{name:>10} {np.median(times) * 1e3:>12.3f} {np.percentile(times, 99) * 1e3:>10.3f}")
@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(f"{THIS_DIR}/../../")
+
+# Libraries that should only load on the code paths that use them.
+HEAVY_MODULES = ["librosa", "matplotlib", "sounddevice", "fluidsynth", "music21", "pretty_midi", "scipy"]
+
+# Imports the child process runs, timing the import and reporting which heavy modules it pulled in.
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(module, repeats):
+    """
+    Import a module in fresh interpreters, so every measurement is a cold start.
+    :param module: dotted module name
+    :param repeats: number of interpreters to start
+    :return: list of import times in seconds, heavy modules loaded by the import
+    """
+    times, loaded = [], []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", CHILD.format(root=ROOT_DIR, module=module, heavy=HEAVY_MODULES)],
+                                cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result["time"])
+        loaded = result["loaded"]
+    return times, loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time cold imports of the follower, server and score modules')
+    parser.add_argument('--modules', metavar='modules', type=str, nargs='+',
+                        default=["src.model.follower", "src.interface.server", "src.interface.headset",
+                                 "src.music.score", "src.model.model"],
+                        help='Modules to import')
+    parser.add_argument('--repeats', metavar='repeats', type=int, default=5, help='Cold imports per module')
+    parser.add_argument('--output', metavar='output', type=str, default=None,
+                        help='JSON file to write results to')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'module':<24} {'median (s)':>10} {'max (s)':>8}  heavy modules loaded")
+    for module in args.modules:
+        times, loaded = time_import(module, args.repeats)
+        print(f"{module:<24} {np.median(times):>10.3f} {max(times):>8.3f}  {', '.join(loaded) or '-'}")
+        results.append({"module": module, "median": float(np.median(times)), "max": max(times), "times": times,
+                        "heavy_modules_loaded": loaded})
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
@@ -0,0 +1,115 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.append("../../")
+
+from src.model.model import Model
+from src.music.note import Pitch
+from src.music.score import SyntheticScore
+
+
+def synthesize_observations(model, num_frames, frames_per_event=4, noise=0.05, seed=0):
+    """
+    Chroma vectors that walk through the score at a steady pace, each the mean chroma of the expected pitch plus noise.
+    :param model: Model to take the score and pitch means from
+    :param num_frames: number of observations
+    :param frames_per_event: frames spent on each score event
+    :param noise: standard deviation of the gaussian noise
+    :param seed: random seed
+    :return: num_frames x 12 matrix
+    """
+    random_state = np.random.RandomState(seed)
+    events = np.minimum(np.arange(num_frames) // frames_per_event, model.N - 1)
+    pitches = model.score.get_solo_pitches()[events] - Pitch.REST.value
+    observations = model.mu_mat[pitches] + noise * random_state.randn(num_frames, 12)
+    return np.clip(observations, 0, None)
+
+
+def benchmark(num_events, L, num_frames, beam_width=None):
+    """
+    Construct a Model for a synthetic score and step it through num_frames observations.
+    :param num_events: score length N
+    :param L: bottom states per event
+    :param num_frames: frames to step
+    :param beam_width: beam width, full forward algorithm if None
+    :return: dict of results, times in seconds and memory in bytes
+    """
+    score = SyntheticScore(num_events)
+
+    start = time.perf_counter()
+    model = Model(None, score=score, L=L, beam_width=beam_width)
+    construction_time = time.perf_counter() - start
+
+    observations = synthesize_observations(model, num_frames)
+    step_times = np.zeros(num_frames)
+    for t in range(num_frames):
+        start = time.perf_counter()
+        model.next_observation(observations[t])
+        step_times[t] = time.perf_counter() - start
+
+    # tracemalloc slows numpy down, so memory is measured in a separate, shorter run
+    tracemalloc.start()
+    model = Model(None, score=score, L=L, beam_width=beam_width)
+    _, construction_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for t in range(min(num_frames, 20)):
+        model.next_observation(observations[t])
+    _, step_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "N": num_events,
+        "L": L,
+        "beam_width": beam_width,
+        "frames": num_frames,
+        "construction_time": construction_time,
+        "step_time_mean": float(np.mean(step_times)),
+        "step_time_p50": float(np.percentile(step_times, 50)),
+        "step_time_p95": float(np.percentile(step_times, 95)),
+        "step_time_p99": float(np.percentile(step_times, 99)),
+        "frames_per_second": float(num_frames / np.sum(step_times)),
+        "construction_peak_memory": construction_peak,
+        "step_peak_memory": step_peak,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark Model construction and next_observation against score '
+                                                 'length and number of bottom states')
+    parser.add_argument('--events', metavar='events', type=int, nargs='+', default=[17, 200, 2000, 20000],
+                        help='Number of score events to benchmark, 17 is the size of TestTwinkle')
+    parser.add_argument('--L', metavar='L', type=int, nargs='+', default=[1, 2], help='Bottom states per event')
+    parser.add_argument('--frames', metavar='frames', type=int, default=500, help='Frames to step per benchmark')
+    parser.add_argument('--beam-width', metavar='beam_width', type=int, default=None,
+                        help='Benchmark beam pruning with this width')
+    parser.add_argument('--output', metavar='output', type=str, default=None,
+                        help='JSON file to write results to, stdout if not given')
+    args = parser.parse_args()
+
+    results = []
+    for L in args.L:
+        for num_events in args.events:
+            result = benchmark(num_events, L, args.frames, args.beam_width)
+            print(f"N={num_events:>6} L={L} construction {result['construction_time']:.4f}s, "
+                  f"step p50 {result['step_time_p50'] * 1e6:.0f}us p99 {result['step_time_p99'] * 1e6:.0f}us, "
+                  f"{result['frames_per_second']:.0f} frames/s", file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,25 @@
+import argparse
+import sys
+import time
+
+sys.path.append("../../")
+
+from src.model.model import Model
+from src.music.score import SyntheticScore
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time Model construction for synthetic scores of increasing length')
+    parser.add_argument('--events', metavar='events', type=int, nargs='+', default=[20, 200, 2000, 20000],
+                        help='Number of score events to benchmark')
+    parser.add_argument('--repeats', metavar='repeats', type=int, default=3, help='Constructions per score length')
+    args = parser.parse_args()
+
+    print(f"{'events':>8} {'best (s)':>10} {'mean (s)':>10}")
+    for num_events in args.events:
+        score = SyntheticScore(num_events)
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            Model(None, score=score)
+            timings.append(time.perf_counter() - start)
+        print(f"{num_events:>8} {min(timings):>10.4f} {sum(timings) / len(timings):>10.4f}")
@@ -1,9 +1,11 @@
 import argparse
 import logging
+import signal
 import sys
 
 sys.path.append("../../")
 
+from src.interface.audio import QueuePolicy
 from src.model.follower import Follower
 from src.music.score import Pieces
 
@@ -13,9 +15,23 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Follow playing without headset')
     parser.add_argument('piece', metavar='piece', type=str, help='Name of piece to be played')
     parser.add_argument('tempo', metavar='tempo', type=int, help='Tempo in bpm (quarter note)')
+    parser.add_argument('--lookahead', action='store_true',
+                        help='Play accompaniment at the predicted onset of each event instead of once it is found')
+    parser.add_argument('--catch-up', action='store_true',
+                        help='Keep at most --queue-size observations and let the model take the whole backlog at once '
+                             'when it falls behind, instead of following every frame')
+    parser.add_argument('--queue-size', metavar='queue_size', type=int, default=32,
+                        help='Observations kept with --catch-up')
+    parser.add_argument('--streaming-chroma', action='store_true',
+                        help='Extract chroma with StreamingChroma instead of librosa, much cheaper per block')
     args = parser.parse_args()
 
     piece = Pieces(args.piece)
+    queue_size, queue_policy = (args.queue_size, QueuePolicy.CatchUp) if args.catch_up else (None, QueuePolicy.Block)
 
-    follower = Follower(with_headset=False, piece=piece, bpm=60)
+    follower = Follower(with_headset=False, piece=piece, bpm=60, lookahead=args.lookahead,
+                        queue_size=queue_size, queue_policy=queue_policy, streaming_chroma=args.streaming_chroma)
+    # kill -USR1 <pid> prints the latency of every stage without stopping
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: follower.dump_latency())
     follower.follow()
@@ -1,9 +1,12 @@
 import argparse
 import logging
+import signal
 import sys
 
 sys.path.append("../../")
 
+from src.interface.audio import QueuePolicy
+from src.interface.headset import MessageFormat
 from src.model.follower import Follower
 
 logging.getLogger().setLevel(logging.INFO)
@@ -12,8 +15,28 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Follow playing with headset')
     parser.add_argument('local_ip', metavar='local_ip', type=str, help='Local IP address for connecting to server')
     parser.add_argument('port', metavar='port', type=int, help='Port for connecting to server')
+    parser.add_argument('--format', metavar='format', type=str, default=MessageFormat.Json.value,
+                        choices=[f.value for f in MessageFormat], help='Accompaniment message format')
+    parser.add_argument('--on-change', action='store_true', help='Only send accompaniment when the event changes')
+    parser.add_argument('--keepalive', metavar='keepalive', type=float, default=None,
+                        help='With --on-change, resend the current event after this many seconds')
+    parser.add_argument('--room', metavar='room', type=str, default="", help='Server room of the ensemble')
+    parser.add_argument('--catch-up', action='store_true',
+                        help='Keep at most --queue-size observations and let the model take the whole backlog at once '
+                             'when it falls behind, instead of following every frame')
+    parser.add_argument('--queue-size', metavar='queue_size', type=int, default=32,
+                        help='Observations kept with --catch-up')
+    parser.add_argument('--streaming-chroma', action='store_true',
+                        help='Extract chroma with StreamingChroma instead of librosa, much cheaper per block')
 
     args = parser.parse_args()
+    queue_size, queue_policy = (args.queue_size, QueuePolicy.CatchUp) if args.catch_up else (None, QueuePolicy.Block)
 
-    follower = Follower(with_headset=True, local_ip=args.local_ip, port=args.port)
+    follower = Follower(with_headset=True, local_ip=args.local_ip, port=args.port,
+                        message_format=MessageFormat(args.format), send_on_change=args.on_change,
+                        keepalive=args.keepalive, room=args.room, queue_size=queue_size,
+                        queue_policy=queue_policy, streaming_chroma=args.streaming_chroma)
+    # kill -USR1 <pid> prints the latency of every stage without stopping
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: follower.dump_latency())
     follower.follow()
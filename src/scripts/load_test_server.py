@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import time
+
+import websockets
+
+sys.path.append("../../")
+
+from src.interface.headset import MessageBuilder, MessageType
+from src.interface.server import SlowClientPolicy, run_server
+from src.utils.latency import LatencyHistogram
+
+
+async def follower(url, rate, duration, binary, index, stats):
+    """
+    Simulated follower sending accompaniment at a fixed rate, timestamped with time.perf_counter().
+    """
+    async with websockets.connect(url) as ws:
+        drain = asyncio.ensure_future(discard(ws))  # messages relayed back to us, read so they don't back up
+        pitches = [60 + index % 12, -1, 55, 48]
+        start = time.perf_counter()
+        event = 0
+        while time.perf_counter() - start < duration:
+            if binary:
+                message = MessageBuilder.build_accompaniment_frame(event, pitches, time.perf_counter())
+            else:
+                payload = MessageBuilder.build_accompaniment_message(pitches)
+                payload["sent"] = time.perf_counter()
+                message = json.dumps(payload)
+            await ws.send(message)
+            stats["sent"] += 1
+            event += 1
+            await asyncio.sleep(max(0.0, start + event / rate - time.perf_counter()))
+        drain.cancel()
+
+
+async def discard(ws):
+    async for _ in ws:
+        pass
+
+
+async def headset(url, histogram, stats, ready, choose_piece, connections):
+    """
+    Simulated headset, optionally sending the song selection and start messages, and timing every accompaniment
+    message it receives. Runs until its connection is closed.
+    """
+    async with websockets.connect(url) as ws:
+        connections.append(ws)
+        if choose_piece:
+            await ws.send(json.dumps({"type": MessageType.ChoosePiece.value,
+                                      "data": {"song_name": "testTwinkle", "tempo": 60}}))
+            await ws.send(json.dumps({"type": MessageType.Start.value}))
+        ready.set()
+        try:
+            async for message in ws:
+                received = time.perf_counter()
+                update = MessageBuilder.parse_message(message)
+                if isinstance(message, str):
+                    sent = json.loads(message).get("sent")
+                else:
+                    sent = update.timestamp
+                if sent is not None:
+                    histogram.record(received - sent)
+                    stats["received"] += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def load_test(port, args):
+    urls = [f"ws://127.0.0.1:{port}/room{room}" for room in range(args.rooms)]
+    histogram = LatencyHistogram()
+    stats = {"sent": 0, "received": 0}
+
+    headset_tasks, connections = [], []
+    for i in range(args.headsets):
+        ready = asyncio.Event()
+        headset_tasks.append(asyncio.ensure_future(
+            headset(urls[i % args.rooms], histogram, stats, ready, i < args.rooms, connections)))
+        await ready.wait()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[follower(urls[i % args.rooms], args.rate, args.duration, args.format == "binary", i,
+                                    stats) for i in range(args.followers)])
+    elapsed = time.perf_counter() - start
+
+    await asyncio.sleep(args.drain)
+    await asyncio.gather(*[ws.close() for ws in connections])
+    await asyncio.gather(*headset_tasks)
+    return histogram, stats, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the relay Server with simulated headsets and followers')
+    parser.add_argument('--headsets', metavar='headsets', type=int, default=16, help='Simulated headsets')
+    parser.add_argument('--followers', metavar='followers', type=int, default=4, help='Simulated followers')
+    parser.add_argument('--rooms', metavar='rooms', type=int, default=1, help='Rooms clients are spread over')
+    parser.add_argument('--rate', metavar='rate', type=float, default=43, help='Messages per second per follower')
+    parser.add_argument('--duration', metavar='duration', type=float, default=10, help='Seconds to send for')
+    parser.add_argument('--drain', metavar='drain', type=float, default=1, help='Seconds to wait for stragglers')
+    parser.add_argument('--format', metavar='format', type=str, default="json", choices=["json", "binary"],
+                        help='Accompaniment message format')
+    parser.add_argument('--queue-size', metavar='queue_size', type=int, default=64, help='Server queue per client')
+    parser.add_argument('--policy', metavar='policy', type=str, default=SlowClientPolicy.Coalesce.value,
+                        choices=[p.value for p in SlowClientPolicy], help='Server policy for slow clients')
+    parser.add_argument('--output', metavar='output', type=str, default=None, help='JSON file to write results to')
+    args = parser.parse_args()
+    args.rooms = max(1, min(args.rooms, args.headsets))
+    logging.getLogger().setLevel(logging.WARNING)  # the server logs every connection
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=run_server, args=(
+        child_connection, args.queue_size, args.policy, False), daemon=True)
+    server_process.start()
+    port = parent_connection.recv()
+
+    histogram, stats, elapsed = asyncio.run(load_test(port, args))
+
+    parent_connection.send("stop")
+    server_stats = parent_connection.recv()
+    server_process.join()
+
+    # Every message goes to each headset in the follower's room
+    headsets_per_room = [len(range(room, args.headsets, args.rooms)) for room in range(args.rooms)]
+    expected = sum(headsets_per_room[i % args.rooms] * (stats["sent"] // args.followers) for i in
+                   range(args.followers))
+    report = {
+        "config": vars(args),
+        "sent": stats["sent"],
+        "received": stats["received"],
+        "expected": expected,
+        "delivered_ratio": stats["received"] / expected if expected else 0.0,
+        "send_rate": stats["sent"] / elapsed,
+        "receive_rate": stats["received"] / elapsed,
+        "latency_ms": histogram.summary(),
+        "server": server_stats,
+        "client_peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+    latency = report["latency_ms"]
+    print(f"{args.followers} followers, {args.headsets} headsets, {args.rooms} rooms, {args.format}")
+    print(f"sent {report['sent']} ({report['send_rate']:.0f}/s), received {report['received']} "
+          f"({report['receive_rate']:.0f}/s), {100 * report['delivered_ratio']:.1f}% delivered")
+    print(f"latency ms: p50 {latency['p50']:.2f} p95 {latency['p95']:.2f} p99 {latency['p99']:.2f} "
+          f"max {latency['max']:.2f}")
+    print(f"server peak rss {server_stats['peak_rss_kb'] / 1024:.1f}MB, "
+          f"dropped {sum(room['dropped'] for room in server_stats['rooms'].values())}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,17 @@
+import argparse
+import sys
+
+sys.path.append("../../")
+
+from src.model.emissions import EmissionPack, EmissionRegistry
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack the per pitch mean and covariance files of an instrument into '
+                                                 'res/<instrument>.npz')
+    parser.add_argument('instrument', metavar='instrument', type=str, help='Instrument directory in res/')
+    args = parser.parse_args()
+
+    pack = EmissionPack.from_directory(args.instrument, EmissionRegistry.RES_DIR)
+    path = f"{EmissionRegistry.RES_DIR}/{args.instrument}.npz"
+    pack.save(path)
+    print(f"Wrote {path}")
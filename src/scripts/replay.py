@@ -0,0 +1,101 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import sys
+import time
+
+sys.path.append("../../")
+
+from src.interface.audio import QueuePolicy, ReplayAudioClient
+from src.interface.headset import MessageFormat, NullHeadsetClient
+from src.interface.server import SlowClientPolicy, run_server
+from src.model.follower import Follower
+from src.music.score import Pieces
+
+logging.getLogger().setLevel(logging.INFO)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Follow a recording instead of the microphone, without audio '
+                                                 'hardware')
+    parser.add_argument('piece', metavar='piece', type=str, help='Name of piece to be played')
+    parser.add_argument('recording', metavar='recording', type=str,
+                        help='Chroma recording (.npy, 12 x frames) or audio file')
+    parser.add_argument('--tempo', metavar='tempo', type=int, default=60, help='Tempo in bpm (quarter note)')
+    parser.add_argument('--speed', metavar='speed', type=float, default=1.0,
+                        help='Playback speed relative to real time, 0 to replay as fast as the follower can go')
+    parser.add_argument('--hop', metavar='hop', type=float, default=None,
+                        help='Seconds between observations at speed 1, blocksize / sample rate by default')
+    parser.add_argument('--streaming-chroma', action='store_true',
+                        help='Extract chroma from audio files with StreamingChroma instead of librosa')
+    parser.add_argument('--catch-up', action='store_true',
+                        help='Keep at most --queue-size observations and let the model take the whole backlog at once '
+                             'when it falls behind, instead of following every frame')
+    parser.add_argument('--queue-size', metavar='queue_size', type=int, default=32,
+                        help='Observations kept with --catch-up')
+    parser.add_argument('--sink', metavar='sink', type=str, default="null", choices=["null", "server", "synth"],
+                        help='Where accompaniment goes: discarded, sent through a local relay Server, or played '
+                             'with fluidsynth')
+    parser.add_argument('--format', metavar='format', type=str, default=MessageFormat.Json.value,
+                        choices=[f.value for f in MessageFormat], help='Accompaniment message format')
+    parser.add_argument('--on-change', action='store_true', help='Only send accompaniment when the event changes')
+    parser.add_argument('--lookahead', action='store_true',
+                        help='With the synth sink, play accompaniment at the predicted onset of each event')
+    parser.add_argument('--verbose', action='store_true', help='Print the state of every frame')
+    parser.add_argument('--output', metavar='output', type=str, default=None, help='JSON file to write results to')
+    args = parser.parse_args()
+
+    queue_size, queue_policy = (args.queue_size, QueuePolicy.CatchUp) if args.catch_up else (None, QueuePolicy.Block)
+    audio_client = ReplayAudioClient(args.recording, speed=args.speed or None, hop=args.hop,
+                                     streaming_chroma=args.streaming_chroma, queue_size=queue_size,
+                                     queue_policy=queue_policy)
+
+    server_process, headset_client, local_ip, port = None, None, None, None
+    if args.sink == "null":
+        headset_client = NullHeadsetClient()
+    elif args.sink == "server":
+        parent_connection, child_connection = multiprocessing.Pipe()
+        server_process = multiprocessing.Process(target=run_server, args=(
+            child_connection, 64, SlowClientPolicy.Coalesce.value, True), daemon=True)
+        server_process.start()
+        local_ip, port = "127.0.0.1", parent_connection.recv()
+
+    follower = Follower(with_headset=args.sink != "synth", piece=Pieces(args.piece), bpm=args.tempo,
+                        local_ip=local_ip, port=port, message_format=MessageFormat(args.format),
+                        send_on_change=args.on_change, audio_client=audio_client, headset_client=headset_client,
+                        verbose=args.verbose, lookahead=args.lookahead)
+
+    start = time.perf_counter()
+    frames = follower.follow()
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "config": vars(args),
+        "frames": frames,
+        "elapsed": elapsed,
+        "frames_per_second": frames / elapsed,
+        "realtime_factor": frames * audio_client.hop / elapsed,
+        "final_event": int(follower.prev_state),
+        "score_events": int(follower.model.score.N),
+        "latency_ms": follower.tracer.summary(),
+        "queue": audio_client.q.get_metrics(),
+    }
+
+    if follower.with_headset:
+        follower.headset_client.close()
+        if isinstance(follower.headset_client, NullHeadsetClient):
+            report["messages"] = {"sent": follower.headset_client.sent, "bytes": follower.headset_client.sent_bytes}
+    if follower.scheduler is not None:
+        report["scheduler"] = follower.scheduler.get_metrics()
+    if server_process is not None:
+        parent_connection.send("stop")
+        report["server"] = parent_connection.recv()
+        server_process.join()
+
+    print(f"{frames} frames in {elapsed:.2f}s, {report['frames_per_second']:.0f} frames/s, "
+          f"{report['realtime_factor']:.1f}x real time, ended on event {report['final_event']} of "
+          f"{report['score_events']}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -7,19 +7,26 @@ import websockets
 
 sys.path.append("../../")
 
-from src.interface.server import Server
+from src.interface.server import Server, SlowClientPolicy
 logging.basicConfig(level=logging.INFO)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Start Websockets Server')
     parser.add_argument('local_ip', metavar='local_ip', type=str, help='Local IP address for server to start')
     parser.add_argument('port', metavar='port', type=int, help='Port server')
+    parser.add_argument('--queue-size', metavar='queue_size', type=int, default=64,
+                        help='Messages queued per client before slow clients start dropping')
+    parser.add_argument('--policy', metavar='policy', type=str, default=SlowClientPolicy.Coalesce.value,
+                        choices=[p.value for p in SlowClientPolicy], help='What to drop for slow clients')
+    parser.add_argument('--no-echo', action='store_true', help="Don't relay messages back to their sender")
     args = parser.parse_args()
 
     logging.info("Starting Server....")
-    server = Server()
-    start_server = websockets.serve(server.ws_handler, args.local_ip, args.port)
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(start_server)
-    logging.info("Started")
-    loop.run_forever()
+    server = Server(args.queue_size, SlowClientPolicy(args.policy), echo=not args.no_echo)
+
+    async def serve():
+        async with websockets.serve(server.ws_handler, args.local_ip, args.port):
+            logging.info("Started")
+            await asyncio.Future()  # run forever
+
+    asyncio.run(serve())
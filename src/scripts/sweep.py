@@ -0,0 +1,92 @@
+import os
+
+# One numpy thread per worker, the pool provides the parallelism.
+for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(var, "1")
+
+import argparse
+import csv
+import itertools
+import logging
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f"{THIS_DIR}/../../")
+
+from src.model.model import Model
+from src.music.score import Pieces
+
+RECORDINGS_DIR = f"{THIS_DIR}/../../res/data/"
+PARAMETERS = ["C", "s", "p_del", "pause_self_loop", "recording_speed"]
+DEFAULT_RUNS = ["testTwinkle:Twinkle_Recording.npy", "testPachabels:Pachabels_Recording.npy"]
+
+
+def run_trial(trial):
+    """
+    Follow one recording with one set of model constants.
+    Accuracy is measured the same way as the integration tests: number of events the follower never visited and
+    how far the average time spent per event is from what the tempo predicts.
+    :param trial: dict with piece, recording, tempo and model parameters
+    :return: dict with the trial and its results
+    """
+    parameters = {name: trial[name] for name in PARAMETERS if trial[name] is not None}
+    model = Model(None, piece=Pieces(trial["piece"]), tempo=trial["tempo"])
+    model.set_parameters(**parameters)
+
+    q = np.load(os.path.join(RECORDINGS_DIR, trial["recording"]))
+    states = np.zeros(model.N + 1, dtype=int)
+
+    start = time.perf_counter()
+    for t in range(len(q[0])):
+        current_state, _ = model.next_observation(q[:, t])
+        states[current_state[0]] += 1
+    elapsed = time.perf_counter() - start
+
+    res = states[1:model.N - 1]
+    desired_note_length = (model.recording_speed * model.score.sub_beat.value) / trial["tempo"]
+    result = dict(trial)
+    result.update({
+        "skipped_notes": int(np.sum(res == 0)),
+        "note_length_error": float(abs(np.mean(res) - desired_note_length)),
+        "break_frames": int(states[model.N]),
+        "frames_per_sec": len(q[0]) / elapsed,
+    })
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Grid search of model constants over recorded performances')
+    parser.add_argument('--runs', metavar='piece:recording', type=str, nargs='+', default=DEFAULT_RUNS,
+                        help='Pieces and the recordings in res/data/ to follow them with')
+    parser.add_argument('--tempo', type=int, nargs='+', default=[60], help='Tempos in bpm')
+    for name in PARAMETERS:
+        parser.add_argument(f'--{name}', type=float, nargs='+', default=[None],
+                            help=f'Values of Model.{name}, model default if not given')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--output', type=str, default='sweep.csv', help='Path of the results table')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    runs = [run.split(':') for run in args.runs]
+    grid = itertools.product(runs, args.tempo, *[getattr(args, name) for name in PARAMETERS])
+    trials = [dict(piece=piece, recording=recording, tempo=tempo, **dict(zip(PARAMETERS, values)))
+              for (piece, recording), tempo, *values in grid]
+    print(f"Running {len(trials)} trials on {args.workers} workers")
+
+    start = time.perf_counter()
+    with Pool(args.workers) as pool:
+        results = list(pool.imap_unordered(run_trial, trials))
+    print(f"Done in {time.perf_counter() - start:.2f}s")
+
+    results.sort(key=lambda result: (result["skipped_notes"], result["note_length_error"]))
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+    for result in results[:10]:
+        print(result)
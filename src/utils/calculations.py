@@ -47,3 +47,16 @@ class MathHelper:
         den = np.sqrt((2 * np.pi) ** k * det)
         np.subtract(x, mu, x)
         return np.squeeze(np.exp(-x[..., None, :] @ inv @ x[..., None] / 2)) / den
+
+    @staticmethod
+    def diagonal_norm_pdf(x, mu, inv_var, log_norm):
+        """
+        multivariate_norm_pdf for gaussians with diagonal covariances, without the k x k matrix products.
+        :param x: ... x k observations, evaluated under every gaussian
+        :param mu: ... x G x k means of G gaussians
+        :param inv_var: ... x G x k inverse variances, the diagonal of the inverse covariances
+        :param log_norm: ... x G log normalizers, log(sqrt((2 pi)^k det))
+        :return: ... x G densities
+        """
+        diff = x[..., None, :] - mu
+        return np.exp(-0.5 * np.einsum('...k,...k->...', diff * diff, inv_var) - log_norm)
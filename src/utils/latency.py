@@ -0,0 +1,108 @@
+import math
+import sys
+import threading
+
+import numpy as np
+
+
+class LatencyHistogram:
+    """
+    Fixed size histogram of latencies with logarithmic buckets, cheap enough to record every frame.
+    Percentiles are accurate to the bucket growth factor (5% by default).
+    """
+
+    def __init__(self, min_latency=1e-6, max_latency=10.0, growth=1.05):
+        """
+        :param min_latency: smallest latency in seconds that gets its own bucket
+        :param max_latency: largest latency in seconds that gets its own bucket
+        :param growth: ratio between the bounds of consecutive buckets
+        """
+        self.min_latency = min_latency
+        self.log_growth = math.log(growth)
+        self.num_buckets = int(math.ceil(math.log(max_latency / min_latency) / self.log_growth)) + 1
+        self.upper_bounds = min_latency * growth ** np.arange(1, self.num_buckets + 1)
+        self.counts = [0] * self.num_buckets  # a list, incrementing it is cheaper than a numpy array
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        """
+        :param latency: seconds
+        :return: None
+        """
+        if latency < self.min_latency:
+            bucket = 0
+        else:
+            bucket = min(int(math.log(latency / self.min_latency) / self.log_growth), self.num_buckets - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def percentile(self, q):
+        """
+        :param q: percentile between 0 and 100
+        :return: upper bound of the bucket holding the q-th percentile in seconds, 0 if nothing was recorded
+        """
+        if self.count == 0:
+            return 0.0
+        bucket = np.searchsorted(np.cumsum(self.counts), q / 100 * self.count)
+        return min(float(self.upper_bounds[bucket]), self.max)
+
+    def summary(self):
+        """
+        :return: dict of count, mean, p50, p95, p99 and max, latencies in milliseconds
+        """
+        return {
+            "count": self.count,
+            "mean": 1000 * self.total / self.count if self.count else 0.0,
+            "p50": 1000 * self.percentile(50),
+            "p95": 1000 * self.percentile(95),
+            "p99": 1000 * self.percentile(99),
+            "max": 1000 * self.max,
+        }
+
+
+class LatencyTracer:
+    """
+    Collection of named LatencyHistograms, one per stage of the pipeline. Stages are created on first use, so the
+    audio, follower and headset threads can all record into the same tracer.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, latency):
+        """
+        :param stage: name of the pipeline stage
+        :param latency: seconds
+        :return: None
+        """
+        if not self.enabled:
+            return
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.stages.setdefault(stage, LatencyHistogram())
+        histogram.record(latency)
+
+    def summary(self):
+        """
+        :return: dict of stage name to its summary, in the order the stages were first recorded
+        """
+        return {stage: histogram.summary() for stage, histogram in list(self.stages.items())}
+
+    def dump(self, file=sys.stderr):
+        """
+        Print a table of the latency of every stage in milliseconds.
+        :param file: where to print
+        :return: None
+        """
+        print(f"{'stage':<16}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}", file=file)
+        for stage, summary in self.summary().items():
+            print(f"{stage:<16}{summary['count']:>8}" + "".join(
+                f"{summary[key]:>10.3f}" for key in ("mean", "p50", "p95", "p99", "max")), file=file)
@@ -0,0 +1,32 @@
+import numpy as np
+import os
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+recordings_path = os.path.join(THIS_DIR, os.pardir, '../res/data/')
+
+from src.music.score import Pieces
+from src.model.batch import BatchModel
+from src.model.model import Model
+
+
+def test_batch_matches_single_sessions():
+    """
+    Follow two different pieces of different lengths in one batch and check each session against its own Model.
+    :return:
+    """
+    sessions = [(Pieces.TestTwinkle, f"{recordings_path}Twinkle_Recording.npy"),
+                (Pieces.TestPachabels, f"{recordings_path}Pachabels_Recording.npy")]
+    recordings = [np.load(recording) for _, recording in sessions]
+    models = [Model(None, piece=piece, tempo=60) for piece, _ in sessions]
+    batch = BatchModel([Model(None, piece=piece, tempo=60) for piece, _ in sessions])
+
+    for t in range(max(len(q[0]) for q in recordings)):
+        active = np.array([t < len(q[0]) for q in recordings])
+        obs = np.stack([q[:, min(t, len(q[0]) - 1)] for q in recordings])
+        events, probs = batch.next_observation(obs, active)
+
+        for b, model in enumerate(models):
+            if active[b]:
+                current_state, prob = model.next_observation(recordings[b][:, t])
+                assert events[b] == current_state[0]
+                assert abs(probs[b] - prob) < 1e-9
@@ -6,16 +6,29 @@ import pytest
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 recordings_path = os.path.join(THIS_DIR, os.pardir, '../res/data/')
 
-from src.music.score import Pieces
+from src.music.score import CompactScore, Pieces, ScoreFactory
+from src.model.emissions import EmissionPack
 from src.model.model import Model
 
 LENGTH_THRESHOLD = 3
-
-
-@pytest.mark.parametrize("piece,tempo,recording", [
+RECORDINGS = [
     (Pieces.TestTwinkle, 60, f"{recordings_path}Twinkle_Recording.npy"),
     (Pieces.TestPachabels, 60, f"{recordings_path}Pachabels_Recording.npy"),
-])
+]
+
+
+def step_together(recording, *models):
+    """
+    Feed every frame of a recording to each model.
+    :param recording: str path to recording
+    :param models: Models to step
+    :return: generator of a tuple of every model's next_observation result per frame
+    """
+    for obs in np.load(recording).T:
+        yield tuple(model.next_observation(obs) for model in models)
+
+
+@pytest.mark.parametrize("piece,tempo,recording", RECORDINGS)
 def test_pieces_integration(piece, tempo, recording):
     """
     Sample audio from recording and put into integration.
@@ -35,16 +48,96 @@ def test_pieces_integration(piece, tempo, recording):
         current_state, prob = model.next_observation(obs)
         t += 1
 
-        if prob < 1.0e-110:
-            model.alpha *= 1.0e100
-
         states[current_state[0]] += 1
 
     res = states[1:len(states) - 1]
     desired_note_length = (model.recording_speed * model.score.sub_beat.value) / tempo
     average_note_length = sum(res) / len(res)
 
+    # Check that scaled forward probabilities never underflowed
+    assert np.isfinite(model.total_log_likelihood)
     # Check no notes were skipped
     assert all(count > 0 for count in res)
     # Check that average note length was within acceptable range
     assert abs(average_note_length - desired_note_length) < LENGTH_THRESHOLD
+
+
+@pytest.mark.parametrize("piece,tempo,recording", RECORDINGS)
+def test_beam_matches_full(piece, tempo, recording):
+    """
+    A beam wide enough to hold the plausible events should follow the recording exactly like the full model.
+    """
+    model = Model(None, piece=piece, tempo=tempo)
+    beam_model = Model(None, piece=piece, tempo=tempo, beam_width=5)
+
+    for (current_state, _), (beam_state, _) in step_together(recording, model, beam_model):
+        assert beam_state[0] == current_state[0]
+        assert beam_model.beam_window is None or beam_model.beam_window[1] - beam_model.beam_window[0] <= 11
+
+
+@pytest.mark.parametrize("piece,tempo,recording", RECORDINGS)
+def test_unscaled_matches_scaled(piece, tempo, recording):
+    """
+    Without scaling alpha should be rescaled before it underflows, following the recording like the scaled model.
+    """
+    model = Model(None, piece=piece, tempo=tempo)
+    unscaled_model = Model(None, piece=piece, tempo=tempo, scaled=False)
+
+    for (current_state, _), (unscaled_state, unscaled_prob) in step_together(recording, model, unscaled_model):
+        assert unscaled_state[0] == current_state[0]
+        assert unscaled_prob > 0
+
+
+@pytest.mark.parametrize("piece,tempo,recording", RECORDINGS)
+def test_align(piece, tempo, recording):
+    """
+    Offline alignment should give the same events as feeding frames one by one, and the viterbi path should
+    move through the score without going backwards.
+    """
+    model = Model(None, piece=piece, tempo=tempo)
+    q = np.load(recording)
+    states = [model.next_observation(obs)[0][0] for obs in q.T]
+
+    alpha, total_log_likelihood = model.alpha.copy(), model.total_log_likelihood
+
+    path, probs = model.align(q.T)
+    assert list(path) == states
+    assert np.all((probs > 0) & (probs <= 1))
+    # align leaves the model where stepping through the frames would have
+    np.testing.assert_allclose(model.alpha, alpha)
+    assert np.isclose(model.total_log_likelihood, total_log_likelihood)
+
+    viterbi_path, viterbi_probs = model.align(q.T, viterbi=True)
+    assert np.all(np.diff(viterbi_path) >= 0)
+    assert np.all((viterbi_probs > 0) & (viterbi_probs <= 1))
+    # Subdivisions of the same note are interchangeable, so only check that the path ends on the last note.
+    assert model.score.subdivided_notes[viterbi_path[-1]].pitch == model.score.subdivided_notes[-1].pitch
+
+
+@pytest.mark.parametrize("piece,tempo,recording", RECORDINGS)
+def test_compact_score_matches(piece, tempo, recording):
+    """
+    A CompactScore should follow the recording exactly like the Score it was converted from.
+    """
+    model = Model(None, piece=piece, tempo=tempo)
+    compact_model = Model(None, tempo=tempo, score=CompactScore.from_score(ScoreFactory.get_score(piece)))
+
+    for result, compact_result in step_together(recording, model, compact_model):
+        assert result == compact_result
+
+
+@pytest.mark.parametrize("piece,tempo,recording", RECORDINGS)
+def test_diagonal_emissions_match(piece, tempo, recording):
+    """
+    The diagonal covariance density should give the same emissions and states as the general one.
+    """
+    model = Model(None, piece=piece, tempo=tempo)
+    general_model = Model(None, piece=piece, tempo=tempo)
+    general_model.emissions = EmissionPack(model.emissions.instrument, model.emissions.mu, model.emissions.sigma)
+    general_model.emissions.is_diagonal = False
+    assert model.emissions.is_diagonal
+
+    q = np.load(recording)
+    assert np.allclose(model._get_pitch_pdf(q.T), general_model._get_pitch_pdf(q.T), rtol=1e-10, atol=1e-300)
+    for (current_state, _), (general_state, _) in step_together(recording, model, general_model):
+        assert current_state == general_state
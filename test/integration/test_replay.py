@@ -0,0 +1,203 @@
+import numpy as np
+import os
+import sys
+import types
+
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+recordings_path = os.path.join(THIS_DIR, os.pardir, '../res/data/')
+
+from src.interface.audio import ObservationQueue, QueueClosed, QueuePolicy, ReplayAudioClient
+from src.interface.headset import NullHeadsetClient
+from src.model.accompaniment import AccompanimentScheduler
+from src.model.follower import Follower
+from src.music.score import Pieces
+
+
+class FakeSynth:
+    """
+    Stand-in for fluidsynth.Synth that records the notes it is asked to play.
+    """
+
+    def __init__(self):
+        self.events = []  # (on, pitch)
+
+    def start(self, driver=None):
+        pass
+
+    def sfload(self, path):
+        return 1
+
+    def program_select(self, channel, sfid, bank, preset):
+        pass
+
+    def noteon(self, channel, pitch, velocity):
+        self.events.append((True, pitch))
+
+    def noteoff(self, channel, pitch):
+        self.events.append((False, pitch))
+
+
+@pytest.fixture
+def fake_fluidsynth(monkeypatch):
+    module = types.ModuleType("fluidsynth")
+    module.Synth = FakeSynth
+    monkeypatch.setitem(sys.modules, "fluidsynth", module)
+
+
+@pytest.mark.parametrize("piece,recording,speed", [
+    (Pieces.TestTwinkle, f"{recordings_path}Twinkle_Recording.npy", None),
+    (Pieces.TestPachabels, f"{recordings_path}Pachabels_Recording.npy", None),
+    (Pieces.TestTwinkle, f"{recordings_path}Twinkle_Recording.npy", 100),
+])
+def test_follow_replay(piece, recording, speed):
+    """
+    Follow a recording through the whole Follower pipeline without audio hardware or a server, and check it gets to
+    the end of the piece and sent accompaniment along the way.
+    :param piece: pieces object
+    :param recording: str path to recording
+    :param speed: replay speed, unthrottled if None
+    :return:
+    """
+    audio_client = ReplayAudioClient(recording, speed=speed)
+    headset_client = NullHeadsetClient()
+    follower = Follower(with_headset=True, piece=piece, bpm=60, audio_client=audio_client,
+                        headset_client=headset_client, verbose=False)
+
+    frames = follower.follow()
+
+    # Every observation plus the one the follower starts the model with
+    assert frames == np.load(recording).shape[1] + 1
+    assert follower.prev_state >= follower.model.score.N - 2
+    assert 0 < headset_client.sent <= frames
+    if speed is None:
+        assert audio_client.q.dropped == 0
+
+
+@pytest.mark.parametrize("piece,recording", [
+    (Pieces.TestTwinkle, f"{recordings_path}Twinkle_Recording.npy"),
+    (Pieces.TestPachabels, f"{recordings_path}Pachabels_Recording.npy"),
+])
+def test_follow_replay_synth(fake_fluidsynth, piece, recording):
+    """
+    Follow a recording without a headset, the accompaniment of the hard coded scores should reach the synth.
+    :param piece: pieces object
+    :param recording: str path to recording
+    :return:
+    """
+    follower = Follower(with_headset=False, piece=piece, bpm=60, audio_client=ReplayAudioClient(recording, speed=None),
+                        verbose=False)
+
+    frames = follower.follow()
+
+    assert frames == np.load(recording).shape[1] + 1
+    score_pitches = {note.pitch for notes in follower.model.score.accompaniment for note in notes}
+    played = [pitch for on, pitch in follower.accompaniment.fs.events if on]
+    assert len(played) > 1 and set(played) <= score_pitches
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SimulatedScheduler(AccompanimentScheduler):
+    """
+    AccompanimentScheduler without a timer thread, on a fake clock that the follower's frames move forward. Before
+    every update the pending event is played at its due time if the frame is past it, like the timer would have.
+    Logs every event played and whether the timer played it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(self._log_play, *args, clock=FakeClock(), timer=False, **kwargs)
+        self.log = []  # (event, played by the timer)
+        self.firing = False
+
+    def update(self, event, timestamp, tempo):
+        while self.pending is not None and self.pending[0] <= timestamp:
+            self.clock.now = self.pending[0]
+            self.firing = True
+            self.poll()
+            self.firing = False
+        self.clock.now = timestamp
+        super().update(event, timestamp, tempo)
+
+    def _log_play(self, event):
+        self.log.append((int(event), self.firing))
+
+
+@pytest.mark.parametrize("piece,recording", [
+    (Pieces.TestTwinkle, f"{recordings_path}Twinkle_Recording.npy"),
+    (Pieces.TestPachabels, f"{recordings_path}Pachabels_Recording.npy"),
+])
+def test_follow_replay_lookahead(fake_fluidsynth, piece, recording):
+    """
+    Follow a recording in simulated real time with lookahead. The timer should only ever play the event after the
+    last one played, events should only go back when the follower does, and the metrics should add up.
+    :param piece: pieces object
+    :param recording: str path to recording
+    :return:
+    """
+    audio_client = ReplayAudioClient(recording, speed=None)
+    follower = Follower(with_headset=False, piece=piece, bpm=60, audio_client=audio_client, verbose=False,
+                        lookahead=True)
+    follower.scheduler.close()
+    follower.scheduler = SimulatedScheduler(follower.scheduler.sub_beat, follower.scheduler.num_events,
+                                            lead=follower.scheduler.lead)
+
+    # Frames captured one hop apart on the fake clock, the replay's own puts are discarded once the queue is closed
+    for index in range(len(audio_client)):
+        audio_client.q.put(audio_client.get_frame(index), index * audio_client.hop)
+    audio_client.q.close()
+
+    follower.follow()
+
+    log = follower.scheduler.log
+    metrics = follower.scheduler.get_metrics()
+    assert {event for event, _ in log} == set(range(follower.model.score.N))
+    for (previous, _), (event, by_timer) in zip(log, log[1:]):
+        assert event == previous + 1 if by_timer else event != previous
+    assert metrics["early"] == sum(by_timer for _, by_timer in log) > len(log) / 2
+    assert metrics["late"] <= len(log) - metrics["early"]
+    assert metrics["mispredicted"] <= metrics["early"]
+
+
+def test_closed_queue_drains():
+    """
+    A closed queue should still hand out what it holds, then raise QueueClosed instead of blocking.
+    :return:
+    """
+    q = ObservationQueue(maxsize=2, policy=QueuePolicy.Block)
+    q.put(1)
+    q.put(2)
+    q.close()
+    q.put(3)  # would block on a full open queue
+
+    assert q.get_batch(timeout=1) == [1, 2]
+    with pytest.raises(QueueClosed):
+        q.get(timeout=1)
+
+
+def test_dropped_frames_count_towards_tempo():
+    """
+    The queue is unbounded and blocking by default. With catch-up, frames the queue drops should still add to the
+    duration of the current note, so the tempo estimate sees every frame that was played.
+    :return:
+    """
+    recording = f"{recordings_path}Twinkle_Recording.npy"
+    assert ReplayAudioClient(recording).q.maxsize is None
+
+    audio_client = ReplayAudioClient(recording, queue_size=2, queue_policy=QueuePolicy.CatchUp)
+    follower = Follower(with_headset=True, piece=Pieces.TestTwinkle, bpm=60, audio_client=audio_client,
+                        headset_client=NullHeadsetClient(), verbose=False)
+    for obs in audio_client.chroma[:5]:
+        audio_client.q.put(obs)
+
+    duration = follower.duration
+    assert len(follower._get_observations(1)) == 2
+    assert follower.duration == duration + 3
+    assert follower.dropped_frames == audio_client.q.dropped == 3
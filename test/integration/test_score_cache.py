@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+
+from src.music.note import Duration
+from src.music.score import ScoreBuilder, ScoreCache
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+MIDI_FILE = f"{THIS_DIR}/../../res/midi/Pachabels/short_pachabels.mid"
+
+
+def test_cached_score_matches_built_score(tmp_path):
+    """
+    A score loaded from the cache should have the same events, flags and mappings as the one ScoreBuilder builds.
+    :return:
+    """
+    built = ScoreBuilder(MIDI_FILE, Duration(0.25)).build()
+    cache = ScoreCache(str(tmp_path))
+    cache.get_score(MIDI_FILE, Duration(0.25))
+    assert os.path.exists(cache.get_path(MIDI_FILE, Duration(0.25)))
+    loaded = cache.get_score(MIDI_FILE, Duration(0.25))
+
+    def as_tuples(notes):
+        return [(note.pitch, getattr(note.duration, "value", note.duration), note.is_note_start, note.is_note_end)
+                for note in notes]
+
+    assert loaded.N == built.N
+    assert loaded.sub_beat.value == built.sub_beat.value
+    assert [loaded.get_true_note_event(i) for i in range(loaded.N)] == [built.get_true_note_event(i) for i in
+                                                                        range(built.N)]
+    assert as_tuples(loaded.notes) == as_tuples(built.notes)
+    assert as_tuples(loaded.subdivided_notes) == as_tuples(built.subdivided_notes)
+    assert as_tuples(note for part in loaded.parts for note in part) == as_tuples(built.parts.flat)
+    assert all(np.array_equal(loaded.get_part_pitches(i), built.get_part_pitches(i)) for i in range(loaded.N + 1))
+    assert all(sorted(as_tuples(loaded.get_accompaniment(i)), key=str) ==
+               sorted(as_tuples(built.get_accompaniment(i)), key=str) for i in range(1, loaded.N + 1))
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from src.model.accompaniment import AccompanimentScheduler
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_scheduled_events_play_on_time():
+    """
+    Follow a steady performance the follower only notices 30ms late, events should still play at their onset.
+    The timer is simulated by polling exactly when the pending event is due.
+    :return:
+    """
+    tempo, num_events, delay, frame = 1000, 8, 0.03, 0.005  # 60ms per event
+    clock = FakeClock()
+    played = []
+    scheduler = AccompanimentScheduler(lambda event: played.append((event, clock())), 1.0, num_events, lead=delay,
+                                       clock=clock, timer=False)
+
+    onsets = [event * 60 / tempo for event in range(num_events)]
+    for k in range(int(round((onsets[-1] + frame) / frame))):
+        t = delay + k * frame
+        while scheduler.pending is not None and scheduler.pending[0] <= t:
+            clock.now = scheduler.pending[0]
+            scheduler.poll()
+        clock.now = t
+        event = max(event for event, onset in enumerate(onsets) if onset + delay <= t + 1e-9)
+        scheduler.update(event, t, tempo)
+    scheduler.close()
+
+    assert [event for event, _ in played] == list(range(num_events))
+    # Every event after the first was played by the timer at its onset, before the follower noticed it
+    assert [played_at for _, played_at in played[1:]] == pytest.approx(onsets[1:])
+    assert scheduler.get_metrics() == {"early": num_events - 1, "late": 0, "cancelled": 0, "mispredicted": 0}
+
+
+def test_follower_overrides_schedule():
+    """
+    The pending event should be played as soon as the follower gets there, and cancelled if it goes elsewhere.
+    :return:
+    """
+    clock = FakeClock(10.0)
+    played = []
+    scheduler = AccompanimentScheduler(played.append, 1.0, 10, clock=clock, timer=False)
+
+    scheduler.update(3, clock(), 60)
+    assert scheduler.pending == (11.0, 4)  # 4 is due in a second
+    scheduler.update(1, clock(), 60)  # the follower jumped back, 2 is due instead
+    assert scheduler.pending == (11.0, 2)
+    clock.now = 10.5
+    scheduler.poll()  # not due yet
+    scheduler.update(2, clock(), 60)
+    assert scheduler.pending == (11.5, 3)
+    scheduler.close()
+
+    assert played == [3, 1, 2]
+    assert scheduler.get_metrics() == {"early": 0, "late": 1, "cancelled": 1, "mispredicted": 0}
+
+
+def test_timer_thread_plays_due_event():
+    """
+    The timer thread should play the pending event on its own once it is due, without busy waiting by default.
+    :return:
+    """
+    clock = FakeClock()
+    played = []
+    scheduler = AccompanimentScheduler(played.append, 1.0, 10, clock=clock)
+    assert scheduler.spin == 0
+
+    scheduler.update(0, clock(), 6000)  # 1 is due after 10ms of the real wait, whatever the fake clock says
+    clock.now = 1.0
+    deadline = time.monotonic() + 5  # only a bound on how long to wait, nothing is timed
+    while len(played) < 2 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    scheduler.close()
+
+    assert played[:2] == [0, 1]
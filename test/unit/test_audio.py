@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from src.interface.audio import AudioClient, StreamingChroma
+from src.model.emissions import EmissionRegistry
+from src.scripts.benchmark_chroma import synthesize_note
+from src.utils.calculations import MathHelper
+
+
+@pytest.mark.parametrize("midi_number", [55, 62, 69, 76, 83, 90])
+def test_streaming_chroma_matches_chroma_cqt(midi_number):
+    """
+    StreamingChroma should give the same chroma as AudioClient.extract_chroma with librosa, so it can be scored
+    against the emission parameters estimated from chroma_cqt.
+    :param midi_number: pitch of the synthesized note
+    :return:
+    """
+    np.random.seed(midi_number)
+    audio_client = AudioClient()
+    block = synthesize_note(midi_number, 4 * audio_client.blocksize, audio_client.sample_rate)[-audio_client.blocksize:]
+
+    expected = audio_client.extract_chroma(block)
+    chroma = StreamingChroma(audio_client.sample_rate, audio_client.blocksize).process(block)
+
+    pack = EmissionRegistry.get("violin")
+    pitch_class = [np.argmax(MathHelper.diagonal_norm_pdf(c, pack.mu, pack.inv_var, pack.log_norm)) - 1
+                   for c in (expected, chroma)]
+    assert np.max(np.abs(chroma - expected)) < 0.1
+    assert pitch_class == [midi_number % 12] * 2
@@ -0,0 +1,21 @@
+import os
+
+import numpy as np
+
+from src.model.emissions import EmissionPack, EmissionRegistry
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+RES_DIR = f"{THIS_DIR}/../../res"
+
+
+def test_pack_matches_directory():
+    """
+    The packed violin parameters should be the ones in res/violin/, and the registry should share one pack.
+    :return:
+    """
+    packed = EmissionPack.load(f"{RES_DIR}/violin.npz")
+    loaded = EmissionPack.from_directory("violin", RES_DIR)
+    for field in ("mu", "sigma", "inv_sigma", "det_sigma"):
+        assert np.array_equal(getattr(packed, field), getattr(loaded, field))
+
+    assert EmissionRegistry.get("violin", RES_DIR) is EmissionRegistry.get("violin", RES_DIR)
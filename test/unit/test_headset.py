@@ -0,0 +1,85 @@
+import asyncio
+import json
+import threading
+
+import pytest
+from websockets import serve
+
+from src.interface.headset import AccompanimentUpdate, HeadsetClient, HeadsetClosed, MessageBuilder
+
+
+def test_accompaniment_formats_parse_alike():
+    """
+    Binary frames and json messages should parse to the same pitches, frames also carry the event and timestamp.
+    :return:
+    """
+    pitches = [62, -1, 57, 50]
+    frame = MessageBuilder.build_accompaniment_frame(123, pitches, 1.5)
+    message = json.dumps(MessageBuilder.build_accompaniment_message(pitches))
+
+    assert MessageBuilder.parse_message(frame) == AccompanimentUpdate(123, pitches, 1.5)
+    assert MessageBuilder.parse_message(message) == AccompanimentUpdate(None, pitches, None)
+    assert len(frame) < len(message) / 4
+
+
+def test_receive_raises_when_server_disconnects():
+    """
+    receive should hand out what arrived before the server went away, then raise instead of blocking forever.
+    :return:
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def handler(ws, *args):
+        await ws.send('{"type": "start"}')
+
+    async def start():
+        return await serve(handler, "127.0.0.1", 0)
+
+    server = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    port = next(iter(server.sockets)).getsockname()[1]
+    client = HeadsetClient("127.0.0.1", port)
+    try:
+        assert client.receive(timeout=5) == '{"type": "start"}'
+        for _ in range(2):
+            with pytest.raises(HeadsetClosed):
+                client.receive(timeout=5)
+    finally:
+        client.close()
+        server.close()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def test_close_sends_queued_messages():
+    """
+    Messages queued right before close should still reach the server, in order.
+    :return:
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    received, disconnected = [], threading.Event()
+
+    async def handler(ws, *args):
+        try:
+            async for message in ws:
+                received.append(message)
+        finally:
+            disconnected.set()
+
+    async def start():
+        return await serve(handler, "127.0.0.1", 0)
+
+    server = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    port = next(iter(server.sockets)).getsockname()[1]
+    try:
+        client = HeadsetClient("127.0.0.1", port)
+        # Large enough that sending has to wait for the socket to drain
+        for i in range(50):
+            client.send(bytes([i]) * 100000)
+        client.close(timeout=5)
+
+        assert disconnected.wait(5)
+        assert [message[0] for message in received] == list(range(50))
+    finally:
+        server.close()
+        loop.call_soon_threadsafe(loop.stop)
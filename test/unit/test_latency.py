@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from src.utils.latency import LatencyHistogram
+
+
+@pytest.mark.parametrize("q", [50, 95, 99])
+def test_histogram_percentiles(q):
+    """
+    Bucketed percentiles should be within the bucket growth factor of the exact percentile.
+    :return:
+    """
+    latencies = np.random.default_rng(0).lognormal(np.log(2e-3), 0.5, 10000)
+    histogram = LatencyHistogram()
+    for latency in latencies:
+        histogram.record(latency)
+
+    exact = np.percentile(latencies, q)
+    assert exact / 1.05 <= histogram.percentile(q) <= exact * 1.05
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pytest
+
+from src.interface.headset import MessageBuilder
+from src.interface.server import ClientConnection, Server, SlowClientPolicy
+
+
+class FakeWebsocket:
+    def __init__(self, path):
+        self.path = path
+        self.remote_address = (path, 0)
+        self.messages = []
+
+    async def send(self, message):
+        self.messages.append(message)
+
+
+def test_rooms_and_coalescing():
+    """
+    Messages should only reach clients in the sender's room, and a client that falls behind should only get the
+    latest accompaniment message while keeping every other message.
+    :return:
+    """
+    async def run():
+        server = Server(policy=SlowClientPolicy.Coalesce)
+        sender, listener, other_room = FakeWebsocket("/q1"), FakeWebsocket("/q1"), FakeWebsocket("/q2")
+        clients = [await server.register(ws, server._get_room(ws, None)) for ws in (sender, listener, other_room)]
+
+        # Queued without yielding to the writer tasks, like a burst the client can't keep up with.
+        for i in range(10):
+            server.send_to_clients(bytes([i]), "q1", clients[0])
+        server.send_to_clients('{"type": "start"}', "q1", clients[0])
+        server.send_to_clients(bytes([10]), "q1", clients[0])
+        await asyncio.sleep(0.01)
+
+        for client in clients:
+            await server.unregister(client)
+        return sender, listener, other_room
+
+    sender, listener, other_room = asyncio.run(run())
+    assert listener.messages == ['{"type": "start"}', bytes([10])]
+    assert sender.messages == listener.messages
+    assert other_room.messages == []
+
+
+@pytest.mark.parametrize("message,expected", [
+    (json.dumps(MessageBuilder.build_accompaniment_message([62, -1])), True),
+    (MessageBuilder.build_accompaniment_frame(1, [62, -1]), True),
+    ('{"type": "song_selection", "data": {"song_name": "accompaniment", "tempo": 60}}', False),
+    ("accompaniment", False),
+])
+def test_is_accompaniment(message, expected):
+    """
+    Only messages whose type is accompaniment may be coalesced, not every message that mentions it.
+    :return:
+    """
+    assert Server._is_accompaniment(message) == expected
+
+
+def test_evicted_accompaniment_is_not_pending():
+    """
+    An accompaniment message pushed out of a full queue should no longer count as pending.
+    :return:
+    """
+    async def run():
+        client = ClientConnection(FakeWebsocket("/"), "default", max_queue=2)
+        client.enqueue(bytes([1]), is_accompaniment=True)
+        client.enqueue('{"type": "start"}')
+        assert client.pending_accompaniments == 1
+        client.enqueue('{"type": "start"}')  # evicts the accompaniment
+        pending = client.pending_accompaniments
+        client.close()
+        return pending
+
+    assert asyncio.run(run()) == 0